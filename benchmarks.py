@@ -0,0 +1,361 @@
+'''Timing suite for the curve, signing, parsing and script hot paths.
+
+    python benchmarks.py                      run everything, print JSON
+    python benchmarks.py --save FILE          also store the results
+    python benchmarks.py --baseline FILE      flag regressions against FILE
+
+Each benchmark is run in samples of `number` calls, with `number`
+calibrated so a sample takes at least MIN_SAMPLE_TIME, and every call
+is timed on its own. Results give ops/sec over all calls and the p50/p99
+of the individual call times in seconds. For the quickest benchmarks a
+call time includes one perf_counter() read, compare those across runs
+rather than against other benchmarks. A
+benchmark counts as a regression when its p50 is more than tolerance
+slower than the baseline's. The exit status is 1 if anything regressed.
+'''
+from io import BytesIO
+from random import Random
+from unittest import TestCase
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for directory in ('transactions', 'elliptic_curves'):
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+MIN_SAMPLE_TIME = 0.002
+REPEAT = 50
+TOLERANCE = 0.10
+
+# name -> setup function returning the zero-argument callable to time
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# Fixed seed so every run times the same inputs
+def rng():
+    return Random(1485)
+
+
+@benchmark('field_add')
+def field_add():
+    from secp256k1 import S256Field, p
+    a, b = S256Field(rng().randrange(p)), S256Field(rng().randrange(p))
+    return lambda: a + b
+
+
+@benchmark('field_mul')
+def field_mul():
+    from secp256k1 import S256Field, p
+    r = rng()
+    a, b = S256Field(r.randrange(p)), S256Field(r.randrange(p))
+    return lambda: a * b
+
+
+@benchmark('field_pow')
+def field_pow():
+    from secp256k1 import S256Field, p
+    a = S256Field(rng().randrange(p))
+    e = rng().randrange(p)
+    return lambda: a ** e
+
+
+@benchmark('field_div')
+def field_div():
+    from secp256k1 import S256Field, p
+    r = rng()
+    a, b = S256Field(r.randrange(p)), S256Field(r.randrange(1, p))
+    return lambda: a / b
+
+
+@benchmark('rmul_g')
+def rmul_g():
+    from secp256k1 import G, N
+    k = rng().randrange(N)
+    return lambda: (k * G).normalize()
+
+
+@benchmark('rmul_point')
+def rmul_point():
+    from secp256k1 import G, N
+    r = rng()
+    point = (r.randrange(N) * G).normalize()
+    k = r.randrange(N)
+    return lambda: (k * point).normalize()
+
+
+@benchmark('sign')
+def sign():
+    from secp256k1 import N, PrivateKey
+    r = rng()
+    key = PrivateKey(r.randrange(1, N))
+    z = r.randrange(2**256)
+    return lambda: key.sign(z)
+
+
+@benchmark('verify')
+def verify():
+    from secp256k1 import N, PrivateKey
+    r = rng()
+    key = PrivateKey(r.randrange(1, N))
+    z = r.randrange(2**256)
+    sig = key.sign(z)
+    point = key.point
+    return lambda: point.verify(z, sig)
+
+
+@benchmark('sec_parse')
+def sec_parse():
+    from secp256k1 import G, N, S256Point
+    sec = (rng().randrange(N) * G).sec()
+    return lambda: S256Point.parse_uncached(sec)
+
+
+@benchmark('sec_parse_cached')
+def sec_parse_cached():
+    from secp256k1 import G, N, S256Point
+    sec = (rng().randrange(N) * G).sec()
+    return lambda: S256Point.parse(sec)
+
+
+# A P2PKH spend of a made up previous tx, put in the Fetcher cache so
+# sig_hash never touches the network. The scriptSig is a placeholder of
+# the usual size until signed_tx signs it
+def spend_tx():
+    from script import Script
+    from secp256k1 import N, PrivateKey
+    from transactions import Fetcher, Tx, TxIn, TxOut
+    key = PrivateKey(rng().randrange(1, N))
+    script_pubkey = Script([0x76, 0xa9, key.point.hash160(), 0x88, 0xac])
+    prev = Tx(1, [TxIn(b'\x11' * 32, 0)],
+              [TxOut(100000, script_pubkey)], 0, testnet=False)
+    Fetcher.cache.put(prev.id(), prev)
+    script_sig = Script([b'\x30' * 72, key.point.sec()])
+    tx = Tx(1, [TxIn(prev.hash(), 0, script_sig)],
+            [TxOut(90000, script_pubkey)], 0, testnet=False)
+    return tx, key
+
+
+def signed_tx():
+    tx, key = spend_tx()
+    tx.sign_input(0, key)
+    return tx
+
+
+@benchmark('tx_parse')
+def tx_parse():
+    from transactions import Tx
+    raw = spend_tx()[0].serialize()
+    return lambda: Tx.parse(BytesIO(raw))
+
+
+@benchmark('tx_parse_buffer')
+def tx_parse_buffer():
+    from transactions import Tx
+    raw = spend_tx()[0].serialize()
+    return lambda: Tx.parse_buffer(raw)
+
+
+@benchmark('tx_serialize')
+def tx_serialize():
+    tx = spend_tx()[0]
+    return tx.serialize
+
+
+@benchmark('tx_sig_hash')
+def tx_sig_hash():
+    tx = spend_tx()[0]
+    return lambda: tx.sig_hash(0)
+
+
+@benchmark('script_evaluate')
+def script_evaluate():
+    from sigcache import SignatureCache
+    combined, z = signed_tx().input_job(0)
+    sig_cache = SignatureCache(maxsize=0)
+    return lambda: combined.evaluate(z, sig_cache)
+
+
+@benchmark('script_interpret')
+def script_interpret():
+    from sigcache import SignatureCache
+    combined, z = signed_tx().input_job(0)
+    sig_cache = SignatureCache(maxsize=0)
+    return lambda: combined.interpret(z, sig_cache)
+
+
+@benchmark('base58_encode')
+def base58_encode():
+    from helper import encode_base58_checksum
+    payload = b'\x00' + bytes(rng().randrange(256) for _ in range(20))
+    return lambda: encode_base58_checksum(payload)
+
+
+@benchmark('base58_decode')
+def base58_decode():
+    from helper import decode_base58, encode_base58_checksum
+    address = encode_base58_checksum(
+        b'\x00' + bytes(rng().randrange(256) for _ in range(20)))
+    return lambda: decode_base58(address)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def calibrate(function, min_time=MIN_SAMPLE_TIME):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - start >= min_time:
+            return number
+        number *= 2
+
+
+# Each call is timed from the end of the previous one, one clock read per
+# call, so the percentiles describe single calls rather than averages
+def measure(function, repeat=REPEAT, min_time=MIN_SAMPLE_TIME):
+    number = calibrate(function, min_time)
+    timings = []
+    clock = time.perf_counter
+    for _ in range(repeat):
+        last = clock()
+        for _ in range(number):
+            function()
+            now = clock()
+            timings.append(now - last)
+            last = now
+    return {
+        'ops_per_sec': len(timings) / sum(timings),
+        'p50': percentile(timings, 0.50),
+        'p99': percentile(timings, 0.99),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(names=None, repeat=REPEAT, min_time=MIN_SAMPLE_TIME):
+    '''Times the named benchmarks (all by default). A benchmark whose setup
+    or call raises is reported with an error instead of timings.'''
+    results = {}
+    for name in names or sorted(BENCHMARKS):
+        try:
+            function = BENCHMARKS[name]()
+            results[name] = measure(function, repeat, min_time)
+        except Exception as e:
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    '''Returns {name: slowdown} for benchmarks whose p50 grew more than
+    tolerance over the baseline, slowdown being new p50 / old p50'''
+    regressions = {}
+    for name, result in report['results'].items():
+        old = baseline['results'].get(name)
+        if old is None or 'p50' not in old or 'p50' not in result:
+            continue
+        slowdown = result['p50'] / old['p50']
+        if slowdown > 1 + tolerance:
+            regressions[name] = slowdown
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', help='benchmarks to run')
+    parser.add_argument('--baseline', help='JSON results to compare to')
+    parser.add_argument('--save', help='write the results here')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--list', action='store_true')
+    args = parser.parse_args(argv)
+    if args.list:
+        print('\n'.join(sorted(BENCHMARKS)))
+        return 0
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(
+            ', '.join(sorted(unknown))))
+    report = run(args.names, repeat=args.repeat)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(report, json.load(f),
+                                            args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 1 if report.get('regressions') else 0
+
+
+class BenchmarkTest(TestCase):
+
+    def test_measure(self):
+        result = measure(lambda: None, repeat=5, min_time=0.0001)
+        self.assertEqual(result['repeat'], 5)
+        self.assertLessEqual(result['p50'], result['p99'])
+        self.assertGreater(result['ops_per_sec'], 0)
+
+    # one slow call in fifty shows in p99 but not in p50, which an
+    # average over a sample would smear out
+    def test_measure_per_call(self):
+        calls = []
+
+        def function():
+            calls.append(None)
+            if len(calls) % 50 == 0:
+                time.sleep(0.01)
+        result = measure(function, repeat=2, min_time=0.05)
+        self.assertGreater(result['p99'], 0.005)
+        self.assertLess(result['p50'], 0.001)
+
+    def test_compare(self):
+        baseline = {'results': {'a': {'p50': 1.0}, 'b': {'p50': 1.0},
+                                'c': {'error': 'ValueError: x'}}}
+        report = {'results': {'a': {'p50': 1.05}, 'b': {'p50': 1.5},
+                              'c': {'p50': 1.0}, 'd': {'p50': 9.0}}}
+        self.assertEqual(compare(report, baseline), {'b': 1.5})
+        self.assertEqual(compare(report, baseline, tolerance=0.01),
+                         {'a': 1.05, 'b': 1.5})
+
+    def test_every_benchmark_runs(self):
+        report = run(repeat=1, min_time=0)
+        errors = {name: result['error']
+                  for name, result in report['results'].items()
+                  if 'error' in result}
+        self.assertEqual(errors, {})
+        self.assertEqual(set(report['results']), set(BENCHMARKS))
+
+    def test_percentile(self):
+        self.assertEqual(percentile(range(101), 0.5), 50)
+        self.assertEqual(percentile(range(101), 0.99), 99)
+        self.assertEqual(percentile([3], 0.99), 3)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+from io import StringIO
+
+import os
+import unittest
+
+# Modular exponentiation and inversion for the field and scalar code.
+# 'python' uses the built-in pow. 'gmpy2', registered when gmpy2 imports,
+# runs them in GMP. Numbers stay plain ints everywhere else (to_bytes,
+# hashing, serialization); results are converted back on the way out.
+# The backend is picked once, at import: $BIGINT_BACKEND if set, otherwise
+# gmpy2 when available, otherwise python.
+
+
+class Backend:
+
+    def __init__(self, name, powmod, invert):
+        self.name = name
+        self.powmod = powmod
+        self.invert = invert
+
+    def __repr__(self):
+        return 'Backend({})'.format(self.name)
+
+
+# moduli are prime, so Fermat. Zero maps to zero, as a ** -1 always has
+def python_invert(a, m):
+    return pow(a, m - 2, m)
+
+
+BACKENDS = {'python': Backend('python', pow, python_invert)}
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+if gmpy2 is not None:
+    def gmpy2_powmod(base, exponent, modulus):
+        return int(gmpy2.powmod(base, exponent, modulus))
+
+    def gmpy2_invert(a, m):
+        if a % m == 0:
+            return 0
+        return int(gmpy2.invert(a, m))
+
+    BACKENDS['gmpy2'] = Backend('gmpy2', gmpy2_powmod, gmpy2_invert)
+
+
+def select_backend(name=None):
+    if name is None:
+        name = os.environ.get('BIGINT_BACKEND')
+    if name is None:
+        name = 'gmpy2' if 'gmpy2' in BACKENDS else 'python'
+    if name not in BACKENDS:
+        raise ValueError('unknown or unavailable big-int backend: {}'.format(
+            name))
+    return BACKENDS[name]
+
+
+BACKEND = select_backend()
+powmod = BACKEND.powmod
+invert = BACKEND.invert
+
+
+@contextmanager
+def use_backend(name):
+    '''Switches the module functions to another backend for the block.
+    Meant for tests and benchmarks, not for concurrent use.'''
+    global BACKEND, powmod, invert
+    saved = BACKEND
+    BACKEND = BACKENDS[name]
+    powmod, invert = BACKEND.powmod, BACKEND.invert
+    try:
+        yield BACKEND
+    finally:
+        BACKEND = saved
+        powmod, invert = BACKEND.powmod, BACKEND.invert
+
+
+class BackendConformanceTest(unittest.TestCase):
+
+    def test_primitives(self):
+        prime = 2**256 - 2**32 - 977
+        for name in BACKENDS:
+            with use_backend(name) as backend:
+                self.assertEqual(backend.powmod(3, prime - 1, prime), 1)
+                self.assertEqual(
+                    backend.invert(12345, prime) * 12345 % prime, 1)
+                self.assertEqual(backend.invert(0, prime), 0)
+                self.assertIs(type(backend.powmod(2, 10, 1000)), int)
+
+    def test_vectors(self):
+        '''Runs the field and curve test cases under every backend'''
+        from finiteFields import FieldElementTest
+        from secp256k1 import PrivateKeyTest, S256Test
+        loader = unittest.defaultTestLoader
+        for name in BACKENDS:
+            suite = unittest.TestSuite(
+                loader.loadTestsFromTestCase(case)
+                for case in (FieldElementTest, S256Test, PrivateKeyTest))
+            with self.subTest(backend=name), use_backend(name):
+                stream = StringIO()
+                result = unittest.TextTestRunner(stream=stream).run(suite)
+                self.assertTrue(result.wasSuccessful(), stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
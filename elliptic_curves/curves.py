@@ -1,5 +1,10 @@
+from opcounts import ACTIVE
+
+
 class Point:
 
+    __slots__ = ('x', 'y', 'a', 'b')
+
     def __init__(self, x, y, a, b):
         self.x = x
         self.y = y
@@ -41,6 +46,9 @@ class Point:
 
         # x and y both are different. Reflect the point. Derived formulas
         if self.x != other.x:
+            counter = ACTIVE.get()
+            if counter is not None:
+                counter.count('add')
             s = (other.y - self.y) / (other.x - self.x)
             # new point
             x = s ** 2 - self.x - other.x
@@ -49,6 +57,9 @@ class Point:
 
         # When points are same. Tangent to curve , derived formulas
         if self == other:
+            counter = ACTIVE.get()
+            if counter is not None:
+                counter.count('double')
             s = (3 * self.x**2 + self.a) / (2 * self.y)
             x = s ** 2 - 2 * self.x
             y = s * (self.x - x) - self.y
@@ -65,6 +76,6 @@ class Point:
             if coef & 1:
                 result += current
             current += current
-            coef >> 1
+            coef >>= 1
         return result
 
@@ -1,8 +1,12 @@
 from curves import Point
+from opcounts import ACTIVE
+import bigint
 import unittest
 
 class FieldElement:
 
+    __slots__ = ('num', 'prime')
+
     def __init__(self, num, prime):
         # We only want prime fields. Order is always -1 of the prime
         if num >= prime or num < 0:
@@ -40,6 +44,9 @@ class FieldElement:
         if self.prime != other.prime:
             raise TypeError('Cannot multiply numbers from different fields')
         result = (self.num * other.num) % self.prime
+        counter = ACTIVE.get()
+        if counter is not None:
+            counter.count('sqr' if other is self else 'mul')
         return self.__class__(result, self.prime)
 
     # Exponent doesn't have to be from same field
@@ -48,7 +55,10 @@ class FieldElement:
         n = exponent
         while n < 0:
             n += self.prime - 1
-        result = pow(self.num, n, self.prime)
+        result = bigint.powmod(self.num, n, self.prime)
+        counter = ACTIVE.get()
+        if counter is not None:
+            counter.count('exp')
         return self.__class__(result, self.prime)
 
     # Fermat's little theorem trick. division is mult. of inverse ie b ^ p-2
@@ -56,7 +66,10 @@ class FieldElement:
     def __truediv__(self, other):
         if self.prime != other.prime:
             raise TypeError('Cannot divide numbers from different fields')
-        result = self.num * pow(other.num, self.prime - 2, self.prime) % self.prime
+        result = self.num * bigint.invert(other.num, self.prime) % self.prime
+        counter = ACTIVE.get()
+        if counter is not None:
+            counter.count_many(inv=1, mul=1)
         return self.__class__(result, self.prime)
 
     def __rmul__(self, coefficient):
@@ -64,6 +77,42 @@ class FieldElement:
         return self.__class__(num=num, prime=self.prime)
 
 
+# Montgomery's trick. Invert the product of all elements once, then peel
+# the individual inverses off with prefix products. N elements cost one
+# exponentiation and ~3N multiplications instead of N exponentiations.
+# Zero has no inverse, it maps to zero like a ** -1 does.
+def batch_inverse_nums(nums, prime):
+    result = list(nums)
+    indices = [i for i, num in enumerate(nums) if num % prime != 0]
+    if not indices:
+        return result
+    prefix = [nums[indices[0]] % prime]
+    for i in indices[1:]:
+        prefix.append(prefix[-1] * nums[i] % prime)
+    inverse = bigint.invert(prefix[-1], prime)
+    for j in reversed(range(1, len(indices))):
+        i = indices[j]
+        result[i] = inverse * prefix[j - 1] % prime
+        inverse = inverse * nums[i] % prime
+    result[indices[0]] = inverse
+    counter = ACTIVE.get()
+    if counter is not None:
+        counter.count_many(inv=1, mul=3 * (len(indices) - 1))
+    return result
+
+
+def batch_inverse(elements):
+    if not elements:
+        return []
+    prime = elements[0].prime
+    for element in elements:
+        if element.prime != prime:
+            raise TypeError('Cannot invert numbers from different fields')
+    nums = batch_inverse_nums([element.num for element in elements], prime)
+    return [element.__class__(num, prime)
+            for element, num in zip(elements, nums)]
+
+
 class FieldElementTest(unittest.TestCase):
 
     def test_eq(self):
@@ -118,6 +167,14 @@ class FieldElementTest(unittest.TestCase):
         b = FieldElement(11, 31)
         self.assertEqual(a**-4 * b, FieldElement(13, 31))
 
+    def test_batch_inverse(self):
+        elements = [FieldElement(n, 31) for n in (3, 0, 17, 1, 30, 0)]
+        expected = [e ** -1 for e in elements]
+        self.assertEqual(batch_inverse(elements), expected)
+        self.assertEqual(batch_inverse([FieldElement(0, 31)]),
+                         [FieldElement(0, 31)])
+        self.assertEqual(batch_inverse([]), [])
+
 
 class EccTest(unittest.TestCase):
 
@@ -0,0 +1,135 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from helper import encode_many, hash160
+from secp256k1 import (
+    G,
+    N,
+    jacobian_add,
+    jacobian_batch_normalize,
+    )
+import os
+import unittest
+
+G_AFFINE = G.to_jacobian()
+
+
+def key_range(start, count, compressed=True, testnet=False, batch_size=256):
+    '''Yields (secret, sec, hash160, address) for secrets start .. start +
+    count - 1.
+
+    Only start * G is a scalar multiplication. Every following point is
+    the previous one plus G, a single mixed jacobian addition, and points
+    are made affine batch_size at a time with one shared inversion.
+    Addresses of a batch go through encode_many together.
+    '''
+    if start < 1 or start + count > N:
+        raise ValueError('secrets must stay within 1 .. N - 1')
+    if testnet:
+        prefix = b'\x6f'
+    else:
+        prefix = b'\x00'
+    current = (start * G).to_jacobian()
+    secret = start
+    end = start + count
+    while secret < end:
+        size = min(batch_size, end - secret)
+        points = []
+        for _ in range(size):
+            points.append(current)
+            current = jacobian_add(current, G_AFFINE)
+        secs = []
+        for x, y, _ in jacobian_batch_normalize(points):
+            if compressed:
+                secs.append(bytes([2 + (y & 1)]) + x.to_bytes(32, 'big'))
+            else:
+                secs.append(b'\x04' + x.to_bytes(32, 'big')
+                            + y.to_bytes(32, 'big'))
+        h160s = [hash160(sec) for sec in secs]
+        addresses = encode_many([prefix + h160 for h160 in h160s])
+        for i in range(size):
+            yield secret + i, secs[i], h160s[i], addresses[i]
+        secret += size
+
+
+# worker side of key_range_parallel, module level so it can be pickled
+def key_range_shard(args):
+    start, count, compressed, testnet, batch_size = args
+    return list(key_range(start, count, compressed, testnet, batch_size))
+
+
+def key_range_parallel(start, count, compressed=True, testnet=False,
+                       batch_size=256, shard_size=65536, workers=None):
+    '''key_range with the range cut into shards of shard_size secrets, each
+    generated in a worker process. Results are yielded in secret order.
+
+    At most two shards per worker are in flight, submitted as earlier ones
+    are consumed, so memory stays bounded however large count is and a
+    slow consumer holds back the workers rather than piling up results.
+    '''
+    if start < 1 or start + count > N:
+        raise ValueError('secrets must stay within 1 .. N - 1')
+    workers = workers or os.cpu_count() or 1
+    shards = ((shard_start, min(shard_size, start + count - shard_start),
+               compressed, testnet, batch_size)
+              for shard_start in range(start, start + count, shard_size))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for shard in shards:
+            if len(in_flight) == workers * 2:
+                yield from in_flight.popleft().result()
+            in_flight.append(executor.submit(key_range_shard, shard))
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+class KeyRangeTest(unittest.TestCase):
+
+    def test_key_range(self):
+        start = 2**200 + 12345
+        keys = list(key_range(start, 20, batch_size=7))
+        self.assertEqual([key[0] for key in keys],
+                         list(range(start, start + 20)))
+        for secret, sec, h160, address in keys:
+            point = secret * G
+            self.assertEqual(sec, point.sec())
+            self.assertEqual(h160, point.hash160())
+            self.assertEqual(address, point.address())
+        secret, sec, h160, address = next(
+            key_range(N - 1, 1, compressed=False, testnet=True))
+        point = (N - 1) * G
+        self.assertEqual(sec, point.sec(compressed=False))
+        self.assertEqual(address, point.address(compressed=False,
+                                                testnet=True))
+        with self.assertRaises(ValueError):
+            next(key_range(0, 1))
+        with self.assertRaises(ValueError):
+            next(key_range(N - 1, 2))
+
+    def test_key_range_parallel(self):
+        self.assertEqual(
+            list(key_range_parallel(1, 10, shard_size=3, workers=2)),
+            list(key_range(1, 10)))
+
+    def test_key_range_parallel_bounded(self):
+        import keyrange
+        submitted = []
+        submit = ProcessPoolExecutor.submit
+
+        def counting_submit(executor, *args):
+            submitted.append(args[1][0])
+            return submit(executor, *args)
+
+        ProcessPoolExecutor.submit = counting_submit
+        try:
+            keys = keyrange.key_range_parallel(1, 100, shard_size=2,
+                                               workers=1)
+            self.assertEqual(next(keys)[0], 1)
+            # a window of two shards for the one worker, not all fifty
+            self.assertEqual(submitted, [1, 3])
+            self.assertEqual(list(keys), list(key_range(2, 99)))
+        finally:
+            ProcessPoolExecutor.submit = submit
+
+
+if __name__ == '__main__':
+    unittest.main()
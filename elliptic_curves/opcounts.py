@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import functools
+
+# Field multiplications, squarings, inversions and exponentiations, point
+# additions and doublings. The jacobian formulas count the field operations
+# they perform as written, FieldElement counts each operator call.
+# Inversions include the scalar ones mod N in sign and verify.
+OPERATIONS = ('mul', 'sqr', 'inv', 'exp', 'add', 'double')
+
+# the OpCounter collecting in the current context, None when not counting.
+# A ContextVar so concurrent requests (threads, asyncio tasks) each see
+# their own counter
+ACTIVE = ContextVar('opcounter', default=None)
+
+
+class OpCounter:
+    '''Operation counts, in total and per high-level call (sign, verify,
+    parse, ...). Calls nested in another counted call add to both.'''
+
+    def __init__(self):
+        self.totals = dict.fromkeys(OPERATIONS, 0)
+        # name -> {'calls': n, operation: count, ...}
+        self.calls = {}
+        # counts of the counted calls in progress, innermost last
+        self.scopes = []
+
+    def count(self, operation, n=1):
+        self.totals[operation] += n
+        for scope in self.scopes:
+            scope[operation] += n
+
+    def count_many(self, **counts):
+        for operation, n in counts.items():
+            self.count(operation, n)
+
+    def enter(self):
+        self.scopes.append(dict.fromkeys(OPERATIONS, 0))
+
+    def exit(self, name):
+        counts = self.scopes.pop()
+        entry = self.calls.get(name)
+        if entry is None:
+            entry = self.calls[name] = dict.fromkeys(OPERATIONS, 0)
+            entry['calls'] = 0
+        entry['calls'] += 1
+        for operation, n in counts.items():
+            entry[operation] += n
+
+    def stats(self):
+        return {'totals': dict(self.totals),
+                'calls': {name: dict(entry)
+                          for name, entry in self.calls.items()}}
+
+
+@contextmanager
+def counting(counter=None):
+    '''Counts every instrumented operation run in the block:
+
+        with counting() as counter:
+            key.sign(z)
+        counter.stats()['calls']['sign']['mul']
+    '''
+    if counter is None:
+        counter = OpCounter()
+    token = ACTIVE.set(counter)
+    try:
+        yield counter
+    finally:
+        ACTIVE.reset(token)
+
+
+def counted(name):
+    '''Decorator attributing the operations of each call to name. When
+    nothing is counting it only costs a ContextVar lookup.'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            counter = ACTIVE.get()
+            if counter is None:
+                return function(*args, **kwargs)
+            counter.enter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                counter.exit(name)
+        return wrapper
+    return decorate
@@ -1,8 +1,11 @@
-from finiteFields import FieldElement
+from finiteFields import FieldElement, batch_inverse_nums
 from curves import Point
+from helper import LRUCache, encode_base58_checksum, hash160
+from opcounts import ACTIVE, counted, counting
+from concurrent.futures import ProcessPoolExecutor
 from random import randint
+import bigint
 import hashlib
-import hmac
 import unittest
 
 p = 2**256 - 2**32 - 977
@@ -12,32 +15,234 @@ N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
 class S256Field(FieldElement):
 
+    __slots__ = ()
+
     def __init__(self, num, prime=None):
         super().__init__(num=num, prime=p)
 
     def __repr__(self):
         return '{:x}'.format(self.num).zfill(64)
 
+    # sqrt function to get y from x. Uses Fermats little theorem
+    # p % 4 == 3 so w^((p+1)/4) is a square root of w
+    def sqrt(self):
+        return self ** ((p + 1) // 4)
+
+
+# Jacobian coordinates. (X, Y, Z) stands for the affine point (X/Z^2, Y/Z^3)
+# and Z = 0 is the point at infinity. Neither formula below divides, so a
+# whole scalar multiplication pays for a single inversion at the end.
+# Doubling is dbl-2009-l (a = 0). Addition is the classic add-1998-cmo-2
+# (U1, U2, S1, S2, H, R and Z3 = Z1 * Z2 * H), or with Z2 = 1 its mixed
+# form, which skips the Z2 powers.
+# Coordinates are plain ints mod p. S256Field objects are only created
+# when a caller reads x or y, so the inner loops allocate nothing but ints.
+# With opcounts counting, each formula reports the field operations below
+# as written: doubling 2M + 5S, mixed addition 8M + 3S, general 12M + 4S.
+INFINITY_JACOBIAN = (1, 1, 0)
+
+
+def jacobian_double(P):
+    X1, Y1, Z1 = P
+    if Z1 == 0 or Y1 == 0:
+        return INFINITY_JACOBIAN
+    xx = X1 * X1 % p
+    yy = Y1 * Y1 % p
+    yyyy = yy * yy % p
+    s = 2 * ((X1 + yy) * (X1 + yy) - xx - yyyy) % p
+    m = 3 * xx % p
+    x3 = (m * m - 2 * s) % p
+    y3 = (m * (s - x3) - 8 * yyyy) % p
+    z3 = 2 * Y1 * Z1 % p
+    counter = ACTIVE.get()
+    if counter is not None:
+        counter.count_many(double=1, mul=2, sqr=5)
+    return x3, y3, z3
+
+
+def jacobian_add(P, Q):
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if Z1 == 0:
+        return Q
+    if Z2 == 0:
+        return P
+    z1z1 = Z1 * Z1 % p
+    u2 = X2 * z1z1 % p
+    s2 = Y2 * Z1 * z1z1 % p
+    # Q affine (Z2 = 1), e.g. a precomputed table entry. Saves 4 mults
+    mixed = Z2 == 1
+    if mixed:
+        u1, s1 = X1, Y1
+    else:
+        z2z2 = Z2 * Z2 % p
+        u1 = X1 * z2z2 % p
+        s1 = Y1 * Z2 * z2z2 % p
+    counter = ACTIVE.get()
+    # same x. Either P == Q (tangent) or P == -Q (vertical line)
+    if u1 == u2:
+        if counter is not None:
+            if mixed:
+                counter.count_many(mul=3, sqr=1)
+            else:
+                counter.count_many(mul=6, sqr=2)
+        if s1 != s2:
+            return INFINITY_JACOBIAN
+        return jacobian_double(P)
+    h = (u2 - u1) % p
+    r = (s2 - s1) % p
+    hh = h * h % p
+    hhh = h * hh % p
+    v = u1 * hh % p
+    x3 = (r * r - hhh - 2 * v) % p
+    y3 = (r * (v - x3) - s1 * hhh) % p
+    if mixed:
+        z3 = Z1 * h % p
+    else:
+        z3 = Z1 * Z2 * h % p
+    if counter is not None:
+        if mixed:
+            counter.count_many(add=1, mul=8, sqr=3)
+        else:
+            counter.count_many(add=1, mul=12, sqr=4)
+    return x3, y3, z3
+
+
+def jacobian_negate(P):
+    X, Y, Z = P
+    return X, -Y % p, Z
+
+
+def jacobian_normalize(P):
+    return jacobian_batch_normalize([P])[0]
+
+
+# Affine (Z = 1) versions of a list of jacobian points sharing one inversion
+def jacobian_batch_normalize(points):
+    z_invs = batch_inverse_nums([Z for _, _, Z in points], p)
+    result = []
+    for (X, Y, Z), z_inv in zip(points, z_invs):
+        if Z == 0:
+            result.append(INFINITY_JACOBIAN)
+            continue
+        z_inv2 = z_inv * z_inv % p
+        result.append((X * z_inv2 % p, Y * z_inv2 * z_inv % p, 1))
+    counter = ACTIVE.get()
+    if counter is not None:
+        finite = sum(1 for _, _, Z in points if Z != 0)
+        counter.count_many(mul=3 * finite, sqr=finite)
+    return result
+
+
+def normalize_points(points):
+    '''Converts S256Points still in jacobian form to affine, in place,
+    with a single shared inversion. Returns the same list.'''
+    pending = [point for point in points if point._jacobian is not None]
+    affine = jacobian_batch_normalize([point._jacobian for point in pending])
+    for point, (X, Y, Z) in zip(pending, affine):
+        point._jacobian = None
+        if Z == 0:
+            point._x, point._y = None, None
+        else:
+            point._x, point._y = S256Field(X), S256Field(Y)
+    return points
+
 
 class S256Point(Point):
 
+    __slots__ = ('_x', '_y', '_jacobian')
+
+    # shared by every point instead of two new field elements per point
+    a = S256Field(A)
+    b = S256Field(B)
+
     def __init__(self, x, y, a=None, b=None):
-        a, b = S256Field(A), S256Field(B)
         if type(x) == int:
-            super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
+            x, y = S256Field(x), S256Field(y)
+        self._x, self._y, self._jacobian = x, y, None
         #Infinity point
-        else:
-            super().__init__(x=x, y=y, a=a, b=b)
+        if x is None and y is None:
+            return
+        if (y.num * y.num - x.num ** 3 - B) % p != 0:
+            raise ValueError('({} {}) is not a point on the curve'.
+                format(x, y))
+
+    # Points coming out of add/rmul are kept in jacobian form and only
+    # converted to affine the first time x or y is read
+    @classmethod
+    def from_jacobian(cls, X, Y, Z):
+        point = cls.__new__(cls)
+        point._x, point._y, point._jacobian = None, None, (X, Y, Z)
+        return point
+
+    # the slots pickle would walk include Point's x and y, which the
+    # properties below shadow, so points pickle as their affine coordinates
+    def __reduce__(self):
+        if self.x is None:
+            return self.__class__, (None, None)
+        return self.__class__, (self.x.num, self.y.num)
+
+    def to_jacobian(self):
+        if self._jacobian is not None:
+            return self._jacobian
+        if self._x is None:
+            return INFINITY_JACOBIAN
+        return self._x.num, self._y.num, 1
+
+    def normalize(self):
+        if self._jacobian is not None:
+            normalize_points([self])
+        return self
+
+    @property
+    def x(self):
+        return self.normalize()._x
+
+    @property
+    def y(self):
+        return self.normalize()._y
+
+    def __add__(self, other):
+        return self.from_jacobian(*jacobian_add(self.to_jacobian(),
+                                                other.to_jacobian()))
 
     def __rmul__(self, coefficient):
         coef = coefficient % N
-        return super().__rmul__(coef)
+        if self is G:
+            return G_TABLE.multiply(coef)
+        if USE_GLV:
+            return self.glv_multiply(coef)
+        return self.double_and_add(coef)
+
+    def glv_multiply(self, coefficient):
+        return multi_multiply([(coefficient, self)], glv=True)
 
+    def double_and_add(self, coefficient):
+        coef = coefficient % N
+        current = self.to_jacobian()
+        result = INFINITY_JACOBIAN
+        while coef:
+            if coef & 1:
+                result = jacobian_add(result, current)
+            current = jacobian_double(current)
+            coef >>= 1
+        return self.from_jacobian(*result)
+
+    # r and s come off the wire: out of range values, and sums landing on
+    # the point at infinity, are invalid rather than an error
+    @counted('verify')
     def verify(self, z, sig):
-        s_inv = pow(sig.s, N - 2, N)
+        if not (1 <= sig.r < N and 1 <= sig.s < N):
+            return False
+        s_inv = bigint.invert(sig.s, N)
+        counter = ACTIVE.get()
+        if counter is not None:
+            counter.count('inv')
         u = z * s_inv % N
         v = sig.r * s_inv % N
-        total = u * G + v * self
+        total = multi_multiply([(u, G), (v, self)])
+        if total.x is None:
+            return False
         return total.x.num == sig.r
 
     # Point encoding
@@ -47,34 +252,43 @@ class S256Point(Point):
     def sec(self, compressed = True):
         if compressed:
             if self.y.num % 2 == 0:
-                return b'\0x02' + self.x.num.to_bytes(32, 'big')
+                return b'\x02' + self.x.num.to_bytes(32, 'big')
             else:
-                return b'\0x03' + self.x.num.to_bytes(32, 'big')
+                return b'\x03' + self.x.num.to_bytes(32, 'big')
         else:
-            return b'\0x04' + self.x.num.to_bytes(32,'big') \
+            return b'\x04' + self.x.num.to_bytes(32,'big') \
                    + self.y.num.to_bytes(32, 'big')
 
-    # sqrt function to get y from x. Uses Fermats little theorem
-    def sqrt(self):
-        return self ** ((P + 1) // 4)
-
+    # Parse public key. Decompressing costs a full exponentiation and the
+    # same keys show up over and over in scripts, so parsed points are
+    # kept in SEC_CACHE keyed on the SEC bytes
+    @classmethod
+    @counted('parse')
+    def parse(cls, sec_bin):
+        key = bytes(sec_bin)
+        point = SEC_CACHE.get(key)
+        if point is None:
+            point = cls.parse_uncached(key)
+            SEC_CACHE.put(key, point)
+        return point
 
-    # Parse public key
     @classmethod
-    def parse(self, sec_bin):
+    def parse_uncached(cls, sec_bin):
+        if len(sec_bin) not in (33, 65):
+            raise SyntaxError('bad SEC length')
         if sec_bin[0] == 4:
             x = int.from_bytes(sec_bin[1:33], 'big')
             y = int.from_bytes(sec_bin[33:65], 'big')
             return S256Point(x=x, y=y)
-        is_even = sec_bin[0] == 2:
+        is_even = sec_bin[0] == 2
         x = S256Field(int.from_bytes(sec_bin[1:], 'big'))
         alpha = x**3 + S256Field(B)
         beta = alpha.sqrt()
         if beta.num % 2 == 0:
             even_beta = beta
-            odd_beta = S256Field(P - beta.num)
+            odd_beta = S256Field(p - beta.num)
         else:
-            even_beta = S256Field(P - beta.num)
+            even_beta = S256Field(p - beta.num)
             odd_beta = beta
         if is_even:
             return S256Point(x, even_beta)
@@ -99,6 +313,187 @@ G = S256Point(
     0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
     0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8)
 
+
+class FixedBaseTable:
+    '''Precomputed multiples of a fixed point.
+
+    The scalar is cut into window-bit digits d_i and
+    k * P = sum(d_i * 2^(window*i) * P). Every d * 2^(window*i) * P is in
+    the table, so a multiplication is ~256/window mixed additions and no
+    doublings at all. The table is built on first use.
+    '''
+
+    def __init__(self, point, window=6):
+        self.point = point
+        self.window = window
+        self.rows = None
+
+    def set_window(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1 bit')
+        self.window = window
+        self.rows = None
+
+    def build(self):
+        size = 1 << self.window
+        base = self.point.to_jacobian()
+        entries = []
+        for _ in range((256 + self.window - 1) // self.window):
+            current = base
+            for _ in range(1, size):
+                entries.append(current)
+                current = jacobian_add(current, base)
+            # current is now 2^window * base, the base of the next row
+            base = current
+        entries = jacobian_batch_normalize(entries)
+        rows = []
+        for start in range(0, len(entries), size - 1):
+            rows.append([INFINITY_JACOBIAN] + entries[start:start + size - 1])
+        self.rows = rows
+
+    def multiply(self, coefficient):
+        if self.rows is None:
+            self.build()
+        coef = coefficient % N
+        mask = (1 << self.window) - 1
+        result = INFINITY_JACOBIAN
+        for row in self.rows:
+            digit = coef & mask
+            if digit:
+                result = jacobian_add(result, row[digit])
+            coef >>= self.window
+        return S256Point.from_jacobian(*result)
+
+
+G_TABLE = FixedBaseTable(G)
+
+SEC_CACHE = LRUCache(maxsize=4096)
+
+
+# GLV endomorphism. BETA is a cube root of unity mod p and LAMBDA one mod N,
+# with LAMBDA * (x, y) = (BETA * x, y). A scalar k is split into
+# k1 + k2 * LAMBDA with k1, k2 around 128 bits, so k * P becomes
+# k1 * P + k2 * (BETA * x, y) and needs half the doublings.
+# Lattice basis (a1, b1), (a2, b2) from "Guide to ECC", alg. 3.74.
+USE_GLV = True
+BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+GLV_B2 = 0x3086d221a7d46bcde86c90e49284eb15
+
+
+def glv_split(coefficient):
+    k = coefficient % N
+    c1 = (GLV_B2 * k + N // 2) // N
+    c2 = (-GLV_B1 * k + N // 2) // N
+    k1 = k - c1 * GLV_A1 - c2 * GLV_A2
+    k2 = -c1 * GLV_B1 - c2 * GLV_B2
+    return k1, k2
+
+
+def jacobian_endomorphism(P):
+    X, Y, Z = P
+    counter = ACTIVE.get()
+    if counter is not None:
+        counter.count('mul')
+    return BETA * X % p, Y, Z
+
+
+# width-w NAF. Digits are 0 or odd with |d| < 2^(w-1), least significant
+# first, and any w consecutive digits hold at most one non-zero
+def wnaf(coefficient, window):
+    digits = []
+    half = 1 << (window - 1)
+    mask = (1 << window) - 1
+    k = coefficient
+    while k:
+        if k & 1:
+            digit = k & mask
+            if digit >= half:
+                digit -= 1 << window
+            k -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        k >>= 1
+    return digits
+
+
+def signed_wnaf(coefficient, window):
+    if coefficient < 0:
+        return [-digit for digit in wnaf(-coefficient, window)]
+    return wnaf(coefficient, window)
+
+
+# P, 3P, 5P, ... (2^(w-1) - 1)P. The wNAF digit d uses entry abs(d) >> 1
+def odd_multiples(P, window):
+    twice = jacobian_double(P)
+    multiples = [P]
+    for _ in range((1 << (window - 2)) - 1):
+        multiples.append(jacobian_add(multiples[-1], twice))
+    return multiples
+
+
+# G is used in every verify, so its odd multiples get a wider window and
+# are kept affine for mixed additions
+G_WNAF_WINDOW = 8
+G_ODD_MULTIPLES = None
+G_LAMBDA_ODD_MULTIPLES = None
+
+
+def multi_multiply(pairs, window=5, glv=None):
+    '''Computes sum(k * P for k, P in pairs) with a single doubling chain.
+
+    Strauss/Shamir's trick with interleaved wNAF: every scalar is recoded
+    to wNAF, then one run of doublings is shared by all the terms and each
+    non-zero digit adds the matching odd multiple of its point.
+    With glv (default USE_GLV) every term is first split in two ~128-bit
+    halves, which halves the length of the chain.
+    '''
+    global G_ODD_MULTIPLES, G_LAMBDA_ODD_MULTIPLES
+    if glv is None:
+        glv = USE_GLV
+    nafs = []
+    tables = []
+    for coefficient, point in pairs:
+        if point is G:
+            if G_ODD_MULTIPLES is None:
+                G_ODD_MULTIPLES = jacobian_batch_normalize(
+                    odd_multiples(G.to_jacobian(), G_WNAF_WINDOW))
+                G_LAMBDA_ODD_MULTIPLES = [jacobian_endomorphism(P)
+                                          for P in G_ODD_MULTIPLES]
+            w = G_WNAF_WINDOW
+            table = G_ODD_MULTIPLES
+            lambda_table = G_LAMBDA_ODD_MULTIPLES
+        else:
+            w = window
+            table = odd_multiples(point.to_jacobian(), window)
+            lambda_table = None
+        if glv:
+            k1, k2 = glv_split(coefficient)
+            if lambda_table is None:
+                lambda_table = [jacobian_endomorphism(P) for P in table]
+            nafs += [signed_wnaf(k1, w), signed_wnaf(k2, w)]
+            tables += [table, lambda_table]
+        else:
+            nafs.append(wnaf(coefficient % N, w))
+            tables.append(table)
+    result = INFINITY_JACOBIAN
+    for i in reversed(range(max(len(naf) for naf in nafs))):
+        result = jacobian_double(result)
+        for naf, table in zip(nafs, tables):
+            if i >= len(naf) or naf[i] == 0:
+                continue
+            digit = naf[i]
+            if digit > 0:
+                result = jacobian_add(result, table[digit >> 1])
+            else:
+                result = jacobian_add(result, jacobian_negate(table[-digit >> 1]))
+    return S256Point.from_jacobian(*result)
+
+
 class Signature:
 
     def __init__(self, r, s):
@@ -106,7 +501,73 @@ class Signature:
         self.s = s
 
     def __repr__(self):
-        return 'Signature({:x}{:x})',format(self.r, self.s)
+        return 'Signature({:x},{:x})'.format(self.r, self.s)
+
+    def der(self):
+        rbin = self.r.to_bytes(32, byteorder='big')
+        rbin = rbin.lstrip(b'\x00')
+        if rbin[0] & 0x80:
+            rbin = b'\x00' + rbin
+        result = bytes([2, len(rbin)]) + rbin
+        sbin = self.s.to_bytes(32, byteorder='big')
+        sbin = sbin.lstrip(b'\x00')
+        if sbin[0] & 0x80:
+            sbin = b'\x00' + sbin
+        result += bytes([2, len(sbin)]) + sbin
+        return bytes([0x30, len(result)]) + result
+
+    # Raises SyntaxError on anything that is not a DER signature
+    @classmethod
+    def parse(cls, signature_bin):
+        signature_bin = bytes(signature_bin)
+        if len(signature_bin) < 8 or signature_bin[0] != 0x30:
+            raise SyntaxError('Bad Signature')
+        if signature_bin[1] + 2 != len(signature_bin):
+            raise SyntaxError('Bad Signature Length')
+        if signature_bin[2] != 0x02:
+            raise SyntaxError('Bad Signature')
+        rlength = signature_bin[3]
+        r = int.from_bytes(signature_bin[4:4 + rlength], 'big')
+        offset = 4 + rlength
+        if offset + 2 > len(signature_bin) or signature_bin[offset] != 0x02:
+            raise SyntaxError('Bad Signature')
+        slength = signature_bin[offset + 1]
+        s = int.from_bytes(signature_bin[offset + 2:offset + 2 + slength],
+                           'big')
+        if len(signature_bin) != 6 + rlength + slength:
+            raise SyntaxError('Signature too long')
+        return cls(r, s)
+
+
+HMAC_IPAD = bytes(c ^ 0x36 for c in range(256))
+HMAC_OPAD = bytes(c ^ 0x5c for c in range(256))
+
+
+# HMAC-SHA256 as its keyed (inner, outer) sha256 states. Each message
+# under the key then costs two state copies instead of a new hmac object
+def hmac_sha256_key(key):
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key.ljust(64, b'\x00')
+    return (hashlib.sha256(key.translate(HMAC_IPAD)),
+            hashlib.sha256(key.translate(HMAC_OPAD)))
+
+
+def hmac_sha256(keyed, message):
+    inner, outer = keyed
+    inner = inner.copy()
+    inner.update(message)
+    outer = outer.copy()
+    outer.update(inner.digest())
+    return outer.digest()
+
+
+# RFC 6979 step d starts every nonce with K = 0x00 * 32 and V = 0x01 * 32,
+# then HMACs V || 0x00 || secret || z. The inner state up to V || 0x00 is
+# the same for every signature and up to the secret the same for every
+# signature of one key, so both are kept and copied instead of rehashed
+RFC6979_INITIAL = hmac_sha256_key(b'\x00' * 32)
+RFC6979_INITIAL[0].update(b'\x01' * 32 + b'\x00')
 
 
 class PrivateKey:
@@ -114,40 +575,62 @@ class PrivateKey:
     def __init__(self, secret):
         self.secret = secret
         self.point = secret * G
+        self.nonce_prefix = None
+
+    # nonce_prefix holds hashlib states, which cannot be pickled. It is
+    # rebuilt by the first sign after unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['nonce_prefix'] = None
+        return state
 
     def hex(self):
         return '{:x}'.format(self.secret).zfill(64)
 
+    @counted('sign')
     def sign(self, z):
         k = self.deterministic_k(z)  # <1>
         r = (k * G).x.num
-        k_inv = pow(k, N - 2, N)
+        k_inv = bigint.invert(k, N)
+        counter = ACTIVE.get()
+        if counter is not None:
+            counter.count('inv')
         s = (z + r * self.secret) * k_inv % N
-        if s > N / 2:
+        if s > N // 2:
             s = N - s
         return Signature(r, s)
 
+    # Signs every z with this key, see sign_many
+    def sign_many(self, zs, workers=None):
+        return sign_many([(self, z) for z in zs], workers=workers)
+
     #rfc6979 for new k for each signature.
 
     def deterministic_k(self, z):
-        k = b'\x00' * 32
         v = b'\x01' * 32
         if z > N:
             z -= N
         z_bytes = z.to_bytes(32, 'big')
         secret_bytes = self.secret.to_bytes(32, 'big')
-        s256 = hashlib.sha256
-        k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
+        if self.nonce_prefix is None:
+            inner, outer = RFC6979_INITIAL
+            inner = inner.copy()
+            inner.update(secret_bytes)
+            self.nonce_prefix = (inner, outer)
+        k = hmac_sha256(self.nonce_prefix, z_bytes)
+        keyed = hmac_sha256_key(k)
+        v = hmac_sha256(keyed, v)
+        k = hmac_sha256(keyed, v + b'\x01' + secret_bytes + z_bytes)
+        keyed = hmac_sha256_key(k)
+        v = hmac_sha256(keyed, v)
         while True:
-            v = hmac.new(k, v, s256).digest()
+            v = hmac_sha256(keyed, v)
             candidate = int.from_bytes(v, 'big')
             if candidate >= 1 and candidate < N:
                 return candidate  # <2>
-            k = hmac.new(k, v + b'\x00', s256).digest()
-            v = hmac.new(k, v, s256).digest()
+            k = hmac_sha256(keyed, v + b'\x00')
+            keyed = hmac_sha256_key(k)
+            v = hmac_sha256(keyed, v)
 
     def wif(self, compressed=True, testnet=False):
         secret_bytes = self.secret.to_bytes(32, 'big')
@@ -162,6 +645,42 @@ class PrivateKey:
         return encode_base58_checksum(prefix + secret_bytes + suffix)
 
 
+@counted('sign_many')
+def sign_many(jobs, workers=None, chunk_size=256):
+    '''Signs a list of (private_key, z) pairs, returns the Signatures in
+    order. Same signatures as private_key.sign(z).
+
+    Nonces come from deterministic_k. Every k * G goes through G_TABLE and
+    stays jacobian, all of them are normalized for r with one shared
+    inversion, and all k are inverted mod N with another. With workers,
+    chunks of chunk_size jobs are signed in a process pool. The keys are
+    pickled with their public point, so workers never redo secret * G.
+    '''
+    jobs = list(jobs)
+    if not workers or len(jobs) <= chunk_size:
+        return sign_chunk(jobs)
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    signatures = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in executor.map(sign_chunk, chunks):
+            signatures.extend(chunk)
+    return signatures
+
+
+def sign_chunk(jobs):
+    ks = [key.deterministic_k(z) for key, z in jobs]
+    points = jacobian_batch_normalize(
+        [G_TABLE.multiply(k).to_jacobian() for k in ks])
+    k_invs = batch_inverse_nums(ks, N)
+    signatures = []
+    for (key, z), (r, _, _), k_inv in zip(jobs, points, k_invs):
+        s = (z + r * key.secret) * k_inv % N
+        if s > N // 2:
+            s = N - s
+        signatures.append(Signature(r, s))
+    return signatures
+
+
 class S256Test(unittest.TestCase):
 
     def test_order(self):
@@ -198,6 +717,146 @@ class S256Test(unittest.TestCase):
         s = 0xc7207fee197d27c618aea621406f6bf5ef6fca38681d82b2f06fddbdce6feab6
         self.assertTrue(point.verify(z, Signature(r, s)))
 
+    def test_verify_out_of_range(self):
+        secret = 0xabc123
+        point = secret * G
+        z = 12345
+        for r, s in ((0, 1), (1, 0), (1, N), (N, 1), (1, 2 * N)):
+            self.assertFalse(point.verify(z, Signature(r, s)))
+        # z = -r * secret makes u * G + v * point the point at infinity
+        self.assertFalse(point.verify(N - secret, Signature(1, 1)))
+
+    def test_jacobian_matches_affine(self):
+        affine_g = Point(G.x, G.y, S256Field(A), S256Field(B))
+        for secret in (1, 2, 3, 1485, 2**128 + 7, N - 1):
+            point = secret * G
+            self.assertEqual(point, secret * affine_g)
+        self.assertEqual(G + G, 2 * G)
+        self.assertEqual(G + (N - 1) * G, N * G)
+        self.assertEqual(3 * G + G, 4 * G)
+
+    def test_fixed_base_table(self):
+        # a copy of G is not G, so it takes the generic double-and-add path
+        generic_g = S256Point(G.x.num, G.y.num)
+        secrets = (0, 1, 63, 64, 1485, 2**128, 2**255 + 19, N - 1, N + 5)
+        for window in (1, 4):
+            table = FixedBaseTable(G, window=window)
+            for secret in secrets:
+                self.assertEqual(table.multiply(secret), secret * generic_g)
+        for secret in secrets:
+            self.assertEqual(secret * G, secret * generic_g)
+
+    def test_normalize_points(self):
+        generic_g = S256Point(G.x.num, G.y.num)
+        points = [k * generic_g for k in (1, 2, 1485, N - 1)]
+        points += [generic_g + (N - 1) * generic_g, G]
+        expected = [S256Point(P.x, P.y) for P in
+                    [k * generic_g for k in (1, 2, 1485, N - 1)]]
+        normalize_points(points)
+        for point in points:
+            self.assertIsNone(point._jacobian)
+        self.assertEqual(points[:4], expected)
+        self.assertIsNone(points[4].x)
+        self.assertEqual(points[5], G)
+
+    def test_parse(self):
+        SEC_CACHE.clear()
+        for secret in (1, 2, 1485, 2**128 + 1):
+            point = secret * G
+            for compressed in (True, False):
+                sec = point.sec(compressed)
+                self.assertEqual(S256Point.parse(sec), point)
+                self.assertIs(S256Point.parse(sec), S256Point.parse(sec))
+        stats = SEC_CACHE.stats()
+        self.assertEqual(stats['misses'], 8)
+        self.assertEqual(stats['hits'], 16)
+
+    def test_wnaf(self):
+        for k in (1, 7, 2**128 - 1, N - 1):
+            for window in (2, 4, 5, 8):
+                digits = wnaf(k, window)
+                self.assertEqual(sum(d << i for i, d in enumerate(digits)), k)
+                for d in digits:
+                    self.assertTrue(d == 0 or (d % 2 == 1 and
+                                               abs(d) < 2**(window - 1)))
+
+    def test_glv_constants(self):
+        self.assertEqual(pow(BETA, 3, p), 1)
+        self.assertEqual(pow(LAMBDA, 3, N), 1)
+        self.assertEqual(LAMBDA * G, S256Point(BETA * G.x.num % p, G.y.num))
+
+    def test_glv_split(self):
+        for k in (0, 1, LAMBDA, 2**128, 2**255 + 12345, N - 1):
+            k1, k2 = glv_split(k)
+            self.assertEqual((k1 + k2 * LAMBDA) % N, k)
+            self.assertLess(abs(k1), 2**129)
+            self.assertLess(abs(k2), 2**129)
+
+    def test_glv_multiply(self):
+        point = 1485 * G
+        for k in (0, 1, 2, LAMBDA, 2**128 + 1, 2**255 - 19, N - 1):
+            self.assertEqual(point.glv_multiply(k), point.double_and_add(k))
+        for glv in (True, False):
+            self.assertEqual(multi_multiply([(2**200 + 3, G), (N - 2, point)],
+                                            glv=glv),
+                             (2**200 + 3) * G + point.double_and_add(N - 2))
+
+    def test_op_counts(self):
+        point = (1485 * G).normalize()
+        with counting() as counter:
+            jacobian_double(point.to_jacobian())
+            jacobian_add(point.to_jacobian(), G.to_jacobian())
+        self.assertEqual(counter.totals, {'mul': 10, 'sqr': 8, 'inv': 0,
+                                          'exp': 0, 'add': 1, 'double': 1})
+        SEC_CACHE.clear()
+        key = PrivateKey(12345)
+        sig = key.sign(99)
+        with counting() as counter:
+            self.assertTrue(key.point.verify(99, sig))
+            S256Point.parse(key.point.sec())
+            S256Point.parse(key.point.sec())
+            key.sign(99)
+        calls = counter.stats()['calls']
+        self.assertEqual(calls['parse']['calls'], 2)
+        # sqrt, plus x**3 in the curve equation
+        self.assertEqual(calls['parse']['exp'], 2)
+        self.assertEqual(calls['verify']['inv'], 2)
+        self.assertGreater(calls['verify']['double'], 100)
+        self.assertEqual(calls['sign']['double'], 0)
+        self.assertEqual(counter.totals['add'], calls['verify']['add'] +
+                         calls['sign']['add'])
+        with counting() as outer:
+            pass
+        key.point.verify(99, sig)
+        self.assertEqual(outer.totals['mul'], 0)
+
+    def test_multi_multiply(self):
+        point = 1485 * G
+        for u, v in ((0, 1), (1, 0), (5, N - 5), (2**200 + 3, 2**255 - 1)):
+            self.assertEqual(multi_multiply([(u, G), (v, point)]),
+                             u * G + v * point)
+        self.assertEqual(multi_multiply([(3, point), (4, point)], window=3),
+                         7 * point)
+
+
+class SignatureTest(unittest.TestCase):
+
+    def test_der(self):
+        cases = (
+            (1, 2),
+            (randint(0, 2**256), randint(0, 2**255)),
+            (randint(0, 2**256), randint(0, 2**255)),
+        )
+        for r, s in cases:
+            der = Signature(r, s).der()
+            sig = Signature.parse(memoryview(der))
+            self.assertEqual((sig.r, sig.s), (r, s))
+        der = Signature(2**255, 1).der()
+        self.assertEqual(der[3], 33)
+        for bad in (b'', der[:-1], b'\x31' + der[1:], der + b'\x00'):
+            with self.assertRaises(SyntaxError):
+                Signature.parse(bad)
+
 
 class PrivateKeyTest(unittest.TestCase):
 
@@ -207,6 +866,35 @@ class PrivateKeyTest(unittest.TestCase):
         sig = pk.sign(z)
         self.assertTrue(pk.point.verify(z, sig))
 
+    def test_sign_many(self):
+        keys = [PrivateKey(secret) for secret in (12345, 2**200 + 7)]
+        zs = [randint(0, 2**256) for _ in range(5)]
+        expected = [key.sign(z) for key in keys for z in zs]
+        jobs = [(key, z) for key in keys for z in zs]
+        for signatures in (sign_many(jobs),
+                           sign_many(jobs, workers=2, chunk_size=3)):
+            self.assertEqual([(sig.r, sig.s) for sig in signatures],
+                             [(sig.r, sig.s) for sig in expected])
+        signatures = keys[0].sign_many(zs)
+        for z, sig in zip(zs, signatures):
+            self.assertTrue(keys[0].point.verify(z, sig))
+
+    def test_pickle_after_sign(self):
+        import pickle
+        pk = PrivateKey(2**128 + 99)
+        z = randint(0, 2**256)
+        sig = pk.sign(z)
+        copy = pickle.loads(pickle.dumps(pk))
+        self.assertIsNotNone(pk.nonce_prefix)
+        self.assertEqual(copy.secret, pk.secret)
+        self.assertEqual(copy.point, pk.point)
+        again = copy.sign(z)
+        self.assertEqual((again.r, again.s), (sig.r, sig.s))
+        # unpickling takes the point as is, no secret * G
+        with counting() as counter:
+            pickle.loads(pickle.dumps(pk))
+        self.assertEqual(counter.totals['double'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,36 +1,93 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from unittest import TestCase, TestSuite
 
 import hashlib
+import struct
+import threading
 
 BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
+# little endian fixed width ints for the buffer parsers
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
+# Numbers are converted ten Base58 digits at a time, so the big int is
+# divided or multiplied once per 58**10 chunk instead of once per digit.
+# Encoding emits digits in pairs (58**2 = 3364), decoding maps characters
+# to digit values with a byte translation table (0xff marks invalid ones)
+BASE58_PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+BASE58_DIGITS = bytes(BASE58_ALPHABET.find(chr(i)) % 256 for i in range(256))
+BASE58_CHUNK = 58 ** 10
+
 def encode_base58(s):
-    count = 0
-    for c in s:
-        if c == 0:
-            count += 1
-        else:
-            break
-    num = int.from_bytes(s,'big')
-    prefix = '1' * count
-    result = ''
+    count = len(s) - len(s.lstrip(b'\x00'))
+    num = int.from_bytes(s, 'big')
+    pairs = BASE58_PAIRS
+    result = []
     while num > 0:
-        num, mod = divmod(num,58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result
+        num, chunk = divmod(num, BASE58_CHUNK)
+        p1, p0 = divmod(chunk, 3364)
+        p2, p1 = divmod(p1, 3364)
+        p3, p2 = divmod(p2, 3364)
+        p4, p3 = divmod(p3, 3364)
+        result += (pairs[p0], pairs[p1], pairs[p2], pairs[p3], pairs[p4])
+    result.reverse()
+    # the top chunk is zero padded
+    return '1' * count + ''.join(result).lstrip('1')
 
 
-def decode_base58(s):
+# Inverse of encode_base58, any length, no checksum
+def decode_base58_raw(s):
+    count = len(s) - len(s.lstrip('1'))
+    try:
+        digits = s[count:].encode('ascii').translate(BASE58_DIGITS)
+    except UnicodeEncodeError:
+        digits = b'\xff'
+    if b'\xff' in digits:
+        raise ValueError('invalid base58 string: {}'.format(s))
+    # left padding with zero digits does not change the number
+    digits = bytes(-len(digits) % 10) + digits
     num = 0
-    for c in s:
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
-    combined = num.to_bytes(25, byteorder='big')
-    checksum = combined[-4:]
-    if hash256(combined[:-4])[:4] != checksum:
+    for i in range(0, len(digits), 10):
+        d0, d1, d2, d3, d4, d5, d6, d7, d8, d9 = digits[i:i + 10]
+        num = num * BASE58_CHUNK + ((((((((
+            d0 * 58 + d1) * 58 + d2) * 58 + d3) * 58 + d4) * 58 + d5)
+            * 58 + d6) * 58 + d7) * 58 + d8) * 58 + d9
+    return b'\x00' * count + num.to_bytes((num.bit_length() + 7) // 8, 'big')
+
+
+# Inverse of encode_base58_checksum, returns the payload with its version
+# byte
+def decode_base58_checksum(s):
+    combined = decode_base58_raw(s)
+    payload, checksum = combined[:-4], combined[-4:]
+    if len(combined) < 4 or hash256(payload)[:4] != checksum:
         raise ValueError('bad address: {} {}'.format(checksum,
-                          hash256(combined[:-4])[:4]))
-    return combined[1:-4]
+                          hash256(payload)[:4]))
+    return payload
+
+
+def decode_base58(s):
+    return decode_base58_checksum(s)[1:]
+
+
+# Bulk forms for long lists of payloads or strings, e.g. hash160s being
+# turned into addresses. checksum=False skips the 4 byte hash256 suffix
+def encode_many(payloads, checksum=True):
+    if not checksum:
+        return [encode_base58(b) for b in payloads]
+    sha256 = hashlib.sha256
+    return [encode_base58(b + sha256(sha256(b).digest()).digest()[:4])
+            for b in payloads]
+
+
+def decode_many(strings, checksum=True):
+    if not checksum:
+        return [decode_base58_raw(s) for s in strings]
+    return [decode_base58_checksum(s) for s in strings]
 
 def p2pkh_script(h160):
     '''Takes a hash160 and returns the p2pkh ScriptPubKey'''
@@ -38,12 +95,46 @@ def p2pkh_script(h160):
 
 
 def hash256(s):
-    return hashlib.sha256(hashlib.sha256(s).digest.()).digest()
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()
 
 def hash160(s):
     return hashlib.new('ripemd160', hashlib.sha256(s).digest()).digest()
 
-def encode_bse58_checksum(b):
+# hashlib only drops the GIL for inputs of at least this many bytes, so
+# threads only pay off on big messages (raw txs), not 64 byte Merkle nodes
+HASH_GIL_MINSIZE = 2048
+
+def hash256_list(messages):
+    sha256 = hashlib.sha256
+    return [sha256(sha256(m).digest()).digest() for m in messages]
+
+def hash160_list(messages):
+    sha256 = hashlib.sha256
+    new = hashlib.new
+    return [new('ripemd160', sha256(m).digest()).digest() for m in messages]
+
+def hash_many(function, messages, workers, chunk_size):
+    messages = list(messages)
+    if not workers or len(messages) <= chunk_size or \
+            sum(map(len, messages)) < HASH_GIL_MINSIZE * len(messages):
+        return function(messages)
+    chunks = [messages[i:i + chunk_size]
+              for i in range(0, len(messages), chunk_size)]
+    result = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for hashes in executor.map(function, chunks):
+            result.extend(hashes)
+    return result
+
+# hash256/hash160 of every message, in order. With workers, lists of large
+# messages are hashed chunk_size at a time on a thread pool
+def hash256_many(messages, workers=None, chunk_size=1024):
+    return hash_many(hash256_list, messages, workers, chunk_size)
+
+def hash160_many(messages, workers=None, chunk_size=1024):
+    return hash_many(hash160_list, messages, workers, chunk_size)
+
+def encode_base58_checksum(b):
     return encode_base58(b + hash256(b)[:4])
 
 def int_to_little_endian(n, length):
@@ -56,21 +147,181 @@ def parse_varint(s):
     i = s.read(1)[0]
     if i == 0xfd:
         return little_endian_to_int(s.read(2))
-    elif i == 0xfe
+    elif i == 0xfe:
         return little_endian_to_int(s.read(4))
-    elif i == oxff:
+    elif i == 0xff:
         return little_endian_to_int(s.read(8))
     else:
         return i
 
+# parse_varint over a bytes/memoryview buffer. Returns (value, new offset)
+def parse_varint_buffer(b, offset):
+    i = b[offset]
+    if i == 0xfd:
+        return UINT16.unpack_from(b, offset + 1)[0], offset + 3
+    elif i == 0xfe:
+        return UINT32.unpack_from(b, offset + 1)[0], offset + 5
+    elif i == 0xff:
+        return UINT64.unpack_from(b, offset + 1)[0], offset + 9
+    else:
+        return i, offset + 1
+
 def encode_varint(i):
     if i < 0xfd:
         return bytes([i])
     elif i < 0x10000:
         return b'\xfd' + int_to_little_endian(i, 2)
     elif i < 0x100000000:
-        return b'\xfd' + int_to_little_endian(i, 4)
-    elif i < 0x1000000000000:
-        return b'\xfd' + int_to_little_endian(i, 8)
+        return b'\xfe' + int_to_little_endian(i, 4)
+    elif i < 0x10000000000000000:
+        return b'\xff' + int_to_little_endian(i, 8)
     else:
-        raise ValueError("Integer too large {}".format(i))
\ No newline at end of file
+        raise ValueError("Integer too large {}".format(i))
+
+
+class LRUCache:
+    '''Size-bounded, thread-safe mapping that evicts the least recently
+    used key once it holds more than maxsize entries.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class LRUCacheTest(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (3, 1, 1))
+        self.assertEqual(stats['size'], 2)
+
+
+class Base58Test(TestCase):
+
+    def naive_encode(self, b):
+        num = int.from_bytes(b, 'big')
+        result = ''
+        while num > 0:
+            num, mod = divmod(num, 58)
+            result = BASE58_ALPHABET[mod] + result
+        return '1' * (len(b) - len(b.lstrip(b'\x00'))) + result
+
+    def test_round_trip(self):
+        payloads = [b'', b'\x00', b'\x00\x00\x01', b'hello world',
+                    bytes(range(256)), b'\x00' * 3 + b'\xff' * 40]
+        payloads += [hashlib.sha256(bytes([i])).digest()[:i % 33]
+                     for i in range(100)]
+        for payload in payloads:
+            encoded = encode_base58(payload)
+            self.assertEqual(encoded, self.naive_encode(payload))
+            self.assertEqual(decode_base58_raw(encoded), payload)
+        self.assertEqual(encode_base58(b'hello world'), 'StV1DL6CwTryKyV')
+        self.assertEqual(decode_many(encode_many(payloads)), payloads)
+        self.assertEqual(
+            decode_many(encode_many(payloads, checksum=False),
+                        checksum=False), payloads)
+
+    def test_checksum(self):
+        address = '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2'
+        h160 = decode_base58(address)
+        self.assertEqual(len(h160), 20)
+        self.assertEqual(encode_base58_checksum(b'\x00' + h160), address)
+        with self.assertRaises(ValueError):
+            decode_base58('1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN3')
+        with self.assertRaises(ValueError):
+            decode_base58('1BvBMSEYstWetqTFn5Au4m4GFg7xJaNV0')
+
+
+class HashManyTest(TestCase):
+
+    def test_hash_many(self):
+        messages = [bytes([i]) * (i * 100) for i in range(50)]
+        expected = [hash256(m) for m in messages]
+        self.assertEqual(hash256_many(messages), expected)
+        self.assertEqual(hash256_many(messages, workers=4, chunk_size=8),
+                         expected)
+        self.assertEqual(hash160_many(messages, workers=4, chunk_size=8),
+                         [hash160(m) for m in messages])
+
+
+class VarintTest(TestCase):
+
+    # the last value of each width and the first of the next
+    VALUES = (0, 0xfc, 0xfd, 0xffff, 0x10000, 0xffffffff, 0x100000000,
+              0xffffffffffffffff)
+
+    def test_round_trip(self):
+        for value in self.VALUES:
+            encoded = encode_varint(value)
+            self.assertEqual(parse_varint(BytesIO(encoded)), value)
+            b = memoryview(b'\xaa' + encoded + b'\xbb')
+            self.assertEqual(parse_varint_buffer(b, 1),
+                             (value, 1 + len(encoded)))
+        self.assertEqual([len(encode_varint(v)) for v in self.VALUES],
+                         [1, 1, 3, 3, 5, 5, 9, 9])
+
+    def test_truncated(self):
+        for value in self.VALUES[2:]:
+            encoded = encode_varint(value)
+            for cut in range(len(encoded)):
+                with self.assertRaises((IndexError, struct.error)):
+                    parse_varint_buffer(encoded[:cut], 0)
@@ -0,0 +1,144 @@
+from helper import (
+    UINT32,
+    hash256,
+    int_to_little_endian,
+    parse_varint_buffer,
+    )
+from merkle import merkle_root
+from transactions import Tx
+from unittest import TestCase
+
+import glob
+import mmap
+import os
+import tempfile
+
+MAINNET_MAGIC = bytes.fromhex('f9beb4d9')
+TESTNET_MAGIC = bytes.fromhex('0b110907')
+HEADER_SIZE = 80
+
+
+class BlockHeader:
+
+    def __init__(self, version, prev_block, merkle_root, timestamp, bits,
+                 nonce):
+        self.version = version
+        self.prev_block = prev_block
+        self.merkle_root = merkle_root
+        self.timestamp = timestamp
+        self.bits = bits
+        self.nonce = nonce
+
+    def __repr__(self):
+        return 'BlockHeader({})'.format(self.id())
+
+    @classmethod
+    def parse_buffer(cls, b, offset=0):
+        version = UINT32.unpack_from(b, offset)[0]
+        prev_block = bytes(b[offset + 4:offset + 36])[::-1]
+        merkle_root = bytes(b[offset + 36:offset + 68])[::-1]
+        timestamp, bits, nonce = (UINT32.unpack_from(b, offset + i)[0]
+                                  for i in (68, 72, 76))
+        header = cls(version, prev_block, merkle_root, timestamp, bits, nonce)
+        return header, offset + HEADER_SIZE
+
+    def serialize(self):
+        result = int_to_little_endian(self.version, 4)
+        result += self.prev_block[::-1]
+        result += self.merkle_root[::-1]
+        result += int_to_little_endian(self.timestamp, 4)
+        result += int_to_little_endian(self.bits, 4)
+        result += int_to_little_endian(self.nonce, 4)
+        return result
+
+    def hash(self):
+        return hash256(self.serialize())[::-1]
+
+    def id(self):
+        return self.hash().hex()
+
+    # tx_hashes as Tx.hash() returns them, in block order
+    def validate_merkle_root(self, tx_hashes):
+        return merkle_root(tx_hashes) == self.merkle_root
+
+
+def block_transactions(block, testnet=False):
+    '''Parses the transactions of one raw block lazily, one per next()'''
+    b = memoryview(block)
+    count, offset = parse_varint_buffer(b, HEADER_SIZE)
+    for _ in range(count):
+        tx, offset = Tx.parse_buffer(b, offset, testnet=testnet)
+        yield tx
+
+
+def read_block_file(path, testnet=False, headers_only=False):
+    '''Walks the magic/size framing of a Bitcoin Core blk*.dat file.
+
+    The file is memory mapped, so only the pages being parsed are
+    resident whatever its size. Yields (header, txs) per block, where txs
+    is a generator over the block's transactions, or just the header with
+    headers_only. Each block is copied out of the map before its
+    transactions are parsed, so the Tx objects (whose script pushes are
+    slices of that copy) stay valid after the file is closed and only
+    pin their own block. Stops at the zero padding Core preallocates.
+    '''
+    magic = TESTNET_MAGIC if testnet else MAINNET_MAGIC
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            offset = 0
+            end = len(m)
+            while offset + 8 <= end:
+                if m[offset:offset + 4] != magic:
+                    if m[offset:offset + 4] == b'\x00\x00\x00\x00':
+                        return
+                    raise ValueError('bad magic at offset {} of {}'.format(
+                        offset, path))
+                size = UINT32.unpack_from(m, offset + 4)[0]
+                start = offset + 8
+                offset = start + size
+                if offset > end:
+                    raise ValueError('truncated block at offset {} of {}'.
+                                     format(start - 8, path))
+                header, _ = BlockHeader.parse_buffer(
+                    m[start:start + HEADER_SIZE])
+                if headers_only:
+                    yield header
+                else:
+                    block = m[start:offset]
+                    yield header, block_transactions(block, testnet=testnet)
+
+
+def read_block_files(directory, testnet=False, headers_only=False):
+    '''read_block_file over every blk*.dat of a Core blocks directory, in
+    file order'''
+    for path in sorted(glob.glob(os.path.join(directory, 'blk*.dat'))):
+        yield from read_block_file(path, testnet=testnet,
+                                   headers_only=headers_only)
+
+
+class BlockFileTest(TestCase):
+
+    raw_tx = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+    raw_header = bytes.fromhex('020000208ec39428b17323fa0ddec8e887b4a7c53b8c0a0a220cfd0000000000000000005b0750fce0a889502d40508d39576821155e9c9e3f5c3157f961db38fd8b25be1e77a759e93c0118a4ffd71d')
+
+    def test_read(self):
+        block = self.raw_header + bytes([2]) + self.raw_tx * 2
+        framed = MAINNET_MAGIC + int_to_little_endian(len(block), 4) + block
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'blk00000.dat')
+            with open(path, 'wb') as f:
+                f.write(framed * 3 + bytes(16))
+            blocks = list(read_block_file(path))
+            self.assertEqual(len(blocks), 3)
+            for header, txs in blocks:
+                self.assertEqual(header.id(), '0000000000000000007e9e4c586439b0cdbe13b1370bdd9435d76a644d047523')
+                txs = list(txs)
+                self.assertEqual([tx.serialize() for tx in txs],
+                                 [self.raw_tx] * 2)
+                self.assertFalse(header.validate_merkle_root(
+                    [tx.hash() for tx in txs]))
+            headers = list(read_block_files(directory, headers_only=True))
+            self.assertEqual([h.serialize() for h in headers],
+                             [self.raw_header] * 3)
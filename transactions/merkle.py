@@ -0,0 +1,151 @@
+from helper import hash256, hash256_many
+from unittest import TestCase
+
+# Hashes go in and come out the way Tx.hash() and BlockHeader.merkle_root
+# hold them (reversed, as displayed). The tree itself works on the
+# internal byte order, where a parent is hash256(left + right) and the
+# last node of an odd level is paired with itself.
+
+
+def merkle_parent(left, right):
+    return hash256(left + right)
+
+
+# Parents are 64 bytes, far below the message size at which hash256_many
+# spreads hashing over threads, so a level is always hashed in one go
+def merkle_parent_level(level):
+    '''Parents of one level of internal order hashes, hashed as a batch'''
+    if len(level) % 2 == 1:
+        level = level + [level[-1]]
+    return hash256_many([level[i] + level[i + 1]
+                         for i in range(0, len(level), 2)])
+
+
+def merkle_levels(leaves):
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        levels.append(merkle_parent_level(levels[-1]))
+    return levels
+
+
+def merkle_root(tx_hashes):
+    if not tx_hashes:
+        raise ValueError('no transactions')
+    leaves = [h[::-1] for h in tx_hashes]
+    return merkle_levels(leaves)[-1][0][::-1]
+
+
+def merkle_proof(tx_hashes, index):
+    '''Sibling hashes from the leaf at index up to the root'''
+    return MerkleTree(tx_hashes).proof(index)
+
+
+def verify_proof(tx_hash, index, proof, root):
+    '''True if proof puts tx_hash at position index under root (SPV)'''
+    current = tx_hash[::-1]
+    for sibling in proof:
+        if index % 2 == 0:
+            current = merkle_parent(current, sibling[::-1])
+        else:
+            current = merkle_parent(sibling[::-1], current)
+        index //= 2
+    return index == 0 and current == root[::-1]
+
+
+class MerkleTree:
+    '''Every level of a block's Merkle tree, kept so that proofs are
+    lookups and changing or appending a leaf rehashes only its path to
+    the root (log2 n hashes) instead of the whole tree.
+    '''
+
+    def __init__(self, tx_hashes):
+        if not tx_hashes:
+            raise ValueError('no transactions')
+        self.levels = merkle_levels([h[::-1] for h in tx_hashes])
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        return self.levels[-1][0][::-1]
+
+    def proof(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('leaf index out of range')
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling == len(level):
+                sibling = index
+            proof.append(level[sibling][::-1])
+            index //= 2
+        return proof
+
+    def update(self, index, tx_hash):
+        if not 0 <= index < len(self):
+            raise IndexError('leaf index out of range')
+        self.levels[0][index] = tx_hash[::-1]
+        self.rehash_path(index)
+
+    def append(self, tx_hash):
+        self.levels[0].append(tx_hash[::-1])
+        self.rehash_path(len(self) - 1)
+
+    def rehash_path(self, index):
+        depth = 0
+        while len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            left = index & ~1
+            if left + 1 < len(level):
+                parent = merkle_parent(level[left], level[left + 1])
+            else:
+                parent = merkle_parent(level[left], level[left])
+            index //= 2
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[depth + 1]
+            if index == len(parents):
+                parents.append(parent)
+            else:
+                parents[index] = parent
+            depth += 1
+
+
+class MerkleTest(TestCase):
+
+    # block 100000
+    tx_hashes = [bytes.fromhex(h) for h in (
+        '8c14f0db3df150123e6f3dbbf30f8b955a8249b62ac1d1ff16284aefa3d06d87',
+        'fff2525b8931402dd09222c50775608f75787bd2b87e56995a7bdd30f79702c4',
+        '6359f0868171b1d194cbee1af2f16ea598ae8fad666d9b012c8ed2b79a236ec4',
+        'e9a66845e05d5abc0ad04ec80f774a7e585c6e8db975962d069a522137b80c1d',
+    )]
+    root = bytes.fromhex(
+        'f3e94742aca4b5ef85488dc37c06c3282295ffec960994b2c0d5ac2a25a95766')
+
+    def test_merkle_root(self):
+        self.assertEqual(merkle_root(self.tx_hashes), self.root)
+        self.assertEqual(merkle_root(self.tx_hashes[:1]), self.tx_hashes[0])
+        self.assertEqual(MerkleTree(self.tx_hashes).root(), self.root)
+
+    def test_proof(self):
+        hashes = [hash256(bytes([i])) for i in range(11)]
+        root = merkle_root(hashes)
+        for index, tx_hash in enumerate(hashes):
+            proof = merkle_proof(hashes, index)
+            self.assertTrue(verify_proof(tx_hash, index, proof, root))
+            self.assertFalse(verify_proof(hash256(tx_hash), index, proof,
+                                          root))
+        proof = merkle_proof(self.tx_hashes, 2)
+        self.assertTrue(verify_proof(self.tx_hashes[2], 2, proof, self.root))
+
+    def test_incremental(self):
+        hashes = [hash256(bytes([i])) for i in range(9)]
+        tree = MerkleTree(hashes[:1])
+        for tx_hash in hashes[1:]:
+            tree.append(tx_hash)
+        self.assertEqual(tree.root(), merkle_root(hashes))
+        hashes[4] = hash256(b'changed')
+        tree.update(4, hashes[4])
+        self.assertEqual(tree.root(), merkle_root(hashes))
+        self.assertEqual(tree.proof(8), merkle_proof(hashes, 8))
@@ -1,6 +1,11 @@
 from helper import (
-    hash160
+    hash160,
+    hash256,
 )
+from secp256k1 import S256Point, Signature
+from unittest import TestCase
+
+import hashlib
 
 def op_dup(stack):
     if len(stack) < 1:
@@ -59,23 +64,620 @@ def op_0(stack):
     return True
 
 
-def op_checksig(stack, z):
+def op_1negate(stack):
+    stack.append(encode_num(-1))
+    return True
+
+
+def op_1(stack):
+    stack.append(encode_num(1))
+    return True
+
+
+def op_2(stack):
+    stack.append(encode_num(2))
+    return True
+
+
+def op_3(stack):
+    stack.append(encode_num(3))
+    return True
+
+
+def op_4(stack):
+    stack.append(encode_num(4))
+    return True
+
+
+def op_5(stack):
+    stack.append(encode_num(5))
+    return True
+
+
+def op_6(stack):
+    stack.append(encode_num(6))
+    return True
+
+
+def op_7(stack):
+    stack.append(encode_num(7))
+    return True
+
+
+def op_8(stack):
+    stack.append(encode_num(8))
+    return True
+
+
+def op_9(stack):
+    stack.append(encode_num(9))
+    return True
+
+
+def op_10(stack):
+    stack.append(encode_num(10))
+    return True
+
+
+def op_11(stack):
+    stack.append(encode_num(11))
+    return True
+
+
+def op_12(stack):
+    stack.append(encode_num(12))
+    return True
+
+
+def op_13(stack):
+    stack.append(encode_num(13))
+    return True
+
+
+def op_14(stack):
+    stack.append(encode_num(14))
+    return True
+
+
+def op_15(stack):
+    stack.append(encode_num(15))
+    return True
+
+
+def op_16(stack):
+    stack.append(encode_num(16))
+    return True
+
+
+def op_nop(stack):
+    return True
+
+
+# items are the cmds still to run. The branch not taken is removed from
+# them, along with the matching OP_ELSE/OP_ENDIF
+def op_if(stack, items):
+    if len(stack) < 1:
+        return False
+    true_items = []
+    false_items = []
+    current_array = true_items
+    found = False
+    num_endifs_needed = 1
+    while len(items) > 0:
+        item = items.pop(0)
+        if item in (99, 100):
+            num_endifs_needed += 1
+            current_array.append(item)
+        elif num_endifs_needed == 1 and item == 103:
+            current_array = false_items
+        elif item == 104:
+            if num_endifs_needed == 1:
+                found = True
+                break
+            else:
+                num_endifs_needed -= 1
+                current_array.append(item)
+        else:
+            current_array.append(item)
+    if not found:
+        return False
+    element = stack.pop()
+    if decode_num(element) == 0:
+        items[:0] = false_items
+    else:
+        items[:0] = true_items
+    return True
+
+
+def op_notif(stack, items):
+    if len(stack) < 1:
+        return False
+    true_items = []
+    false_items = []
+    current_array = true_items
+    found = False
+    num_endifs_needed = 1
+    while len(items) > 0:
+        item = items.pop(0)
+        if item in (99, 100):
+            num_endifs_needed += 1
+            current_array.append(item)
+        elif num_endifs_needed == 1 and item == 103:
+            current_array = false_items
+        elif item == 104:
+            if num_endifs_needed == 1:
+                found = True
+                break
+            else:
+                num_endifs_needed -= 1
+                current_array.append(item)
+        else:
+            current_array.append(item)
+    if not found:
+        return False
+    element = stack.pop()
+    if decode_num(element) == 0:
+        items[:0] = true_items
+    else:
+        items[:0] = false_items
+    return True
+
+
+def op_verify(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    if decode_num(element) == 0:
+        return False
+    return True
+
+
+def op_return(stack):
+    return False
+
+
+def op_toaltstack(stack, altstack):
+    if len(stack) < 1:
+        return False
+    altstack.append(stack.pop())
+    return True
+
+
+def op_fromaltstack(stack, altstack):
+    if len(altstack) < 1:
+        return False
+    stack.append(altstack.pop())
+    return True
+
+
+def op_2drop(stack):
+    if len(stack) < 2:
+        return False
+    stack.pop()
+    stack.pop()
+    return True
+
+
+def op_2dup(stack):
+    if len(stack) < 2:
+        return False
+    stack.extend(stack[-2:])
+    return True
+
+
+def op_3dup(stack):
+    if len(stack) < 3:
+        return False
+    stack.extend(stack[-3:])
+    return True
+
+
+def op_2over(stack):
+    if len(stack) < 4:
+        return False
+    stack.extend(stack[-4:-2])
+    return True
+
+
+def op_2rot(stack):
+    if len(stack) < 6:
+        return False
+    stack.extend(stack[-6:-4])
+    del stack[-8:-6]
+    return True
+
+
+def op_2swap(stack):
+    if len(stack) < 4:
+        return False
+    stack[-4:] = stack[-2:] + stack[-4:-2]
+    return True
+
+
+def op_ifdup(stack):
+    if len(stack) < 1:
+        return False
+    if decode_num(stack[-1]) != 0:
+        stack.append(stack[-1])
+    return True
+
+
+def op_depth(stack):
+    stack.append(encode_num(len(stack)))
+    return True
+
+
+def op_drop(stack):
+    if len(stack) < 1:
+        return False
+    stack.pop()
+    return True
+
+
+def op_nip(stack):
+    if len(stack) < 2:
+        return False
+    stack[-2:] = stack[-1:]
+    return True
+
+
+def op_over(stack):
+    if len(stack) < 2:
+        return False
+    stack.append(stack[-2])
+    return True
+
+
+def op_pick(stack):
+    if len(stack) < 1:
+        return False
+    n = decode_num(stack.pop())
+    if n < 0 or len(stack) < n + 1:
+        return False
+    stack.append(stack[-n - 1])
+    return True
+
+
+def op_roll(stack):
+    if len(stack) < 1:
+        return False
+    n = decode_num(stack.pop())
+    if n < 0 or len(stack) < n + 1:
+        return False
+    if n == 0:
+        return True
+    stack.append(stack.pop(-n - 1))
+    return True
+
+
+def op_rot(stack):
+    if len(stack) < 3:
+        return False
+    stack.append(stack.pop(-3))
+    return True
+
+
+def op_swap(stack):
+    if len(stack) < 2:
+        return False
+    stack.append(stack.pop(-2))
+    return True
+
+
+def op_tuck(stack):
+    if len(stack) < 2:
+        return False
+    stack.insert(-2, stack[-1])
+    return True
+
+
+def op_size(stack):
+    if len(stack) < 1:
+        return False
+    stack.append(encode_num(len(stack[-1])))
+    return True
+
+
+def op_equal(stack):
+    if len(stack) < 2:
+        return False
+    element1 = stack.pop()
+    element2 = stack.pop()
+    if element1 == element2:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_equalverify(stack):
+    return op_equal(stack) and op_verify(stack)
+
+
+def op_1add(stack):
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack.pop())
+    stack.append(encode_num(element + 1))
+    return True
+
+
+def op_1sub(stack):
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack.pop())
+    stack.append(encode_num(element - 1))
+    return True
+
+
+def op_negate(stack):
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack.pop())
+    stack.append(encode_num(-element))
+    return True
+
+
+def op_abs(stack):
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack.pop())
+    if element < 0:
+        stack.append(encode_num(-element))
+    else:
+        stack.append(encode_num(element))
+    return True
+
+
+def op_not(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    if decode_num(element) == 0:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_0notequal(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    if decode_num(element) == 0:
+        stack.append(encode_num(0))
+    else:
+        stack.append(encode_num(1))
+    return True
+
+
+def op_add(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    stack.append(encode_num(element1 + element2))
+    return True
+
+
+def op_sub(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    stack.append(encode_num(element2 - element1))
+    return True
+
+
+def op_mul(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    stack.append(encode_num(element2 * element1))
+    return True
+
+
+def op_booland(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element1 and element2:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_boolor(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element1 or element2:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_numequal(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element1 == element2:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_numequalverify(stack):
+    return op_numequal(stack) and op_verify(stack)
+
+
+def op_numnotequal(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element1 == element2:
+        stack.append(encode_num(0))
+    else:
+        stack.append(encode_num(1))
+    return True
+
+
+def op_lessthan(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element2 < element1:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_greaterthan(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element2 > element1:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_lessthanorequal(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element2 <= element1:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_greaterthanorequal(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element2 >= element1:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_min(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element1 < element2:
+        stack.append(encode_num(element1))
+    else:
+        stack.append(encode_num(element2))
+    return True
+
+
+def op_max(stack):
+    if len(stack) < 2:
+        return False
+    element1 = decode_num(stack.pop())
+    element2 = decode_num(stack.pop())
+    if element1 > element2:
+        stack.append(encode_num(element1))
+    else:
+        stack.append(encode_num(element2))
+    return True
+
+
+def op_within(stack):
+    if len(stack) < 3:
+        return False
+    maximum = decode_num(stack.pop())
+    minimum = decode_num(stack.pop())
+    element = decode_num(stack.pop())
+    if element >= minimum and element < maximum:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
+    return True
+
+
+def op_ripemd160(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    stack.append(hashlib.new('ripemd160', element).digest())
+    return True
+
+
+def op_sha1(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    stack.append(hashlib.sha1(element).digest())
+    return True
+
+
+def op_sha256(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    stack.append(hashlib.sha256(element).digest())
+    return True
+
+
+def op_hash256(stack):
+    if len(stack) < 1:
+        return False
+    element = stack.pop()
+    stack.append(hash256(element))
+    return True
+
+
+# ECDSA check that skips the math for triples already in sig_cache.
+# Raises ValueError/SyntaxError on unparsable keys or signatures
+def check_signature(sec_pubkey, der_signature, z, sig_cache=None):
+    if sig_cache is not None and \
+            sig_cache.contains(sec_pubkey, der_signature, z):
+        return True
+    point = S256Point.parse(sec_pubkey)
+    sig = Signature.parse(der_signature)
+    if not point.verify(z, sig):
+        return False
+    if sig_cache is not None:
+        sig_cache.add(sec_pubkey, der_signature, z)
+    return True
+
+
+def op_checksig(stack, z, sig_cache=None):
     if len(stack) < 2:
         return False
     sec_pubkey = stack.pop()
     der_signature = stack.pop()[:-1]
     try:
-        point = S256Point.parse(sec_pubkey)
-        sig = Signature.parse(der_signature)
+        valid = check_signature(sec_pubkey, der_signature, z, sig_cache)
     except (ValueError, SyntaxError) as e:
         return False
-    if point.verify(z, sig):
+    if valid:
         stack.append(encode_num(1))
     else:
         stack.append(encode_num(0))
     return True
 
-def op_checkmultisig(stack, z):
+def op_checkmultisig(stack, z, sig_cache=None):
     if len(stack) < 1:
         return False
     n = decode_num(stack.pop())
@@ -91,21 +693,86 @@ def op_checkmultisig(stack, z):
     for _ in range(m):
         der_signatures.append(stack.pop()[:-1])
     stack.pop()
+    if not check_multisig(sec_pubkeys, der_signatures, z, sig_cache):
+        return False
+    stack.append(encode_num(1))
+    return True
+
+
+# Keys and signatures in the order op_checkmultisig pops them off the
+# stack. False means the opcode fails
+def check_multisig(sec_pubkeys, der_signatures, z, sig_cache=None):
+    sec_pubkeys = list(sec_pubkeys)
     try:
-        points = [S256Point.parse(sec) for sec in sec_pubkeys]
-        sigs = [Signature.parse(der) for der in der_signatures]
-        for sig in sigs:
-            if len(points) == 0:
+        # parse everything up front so a bad key fails even if unused
+        for sec in sec_pubkeys:
+            S256Point.parse(sec)
+        for der in der_signatures:
+            Signature.parse(der)
+        for der in der_signatures:
+            if len(sec_pubkeys) == 0:
                 return False
-            while points:
-                point = points.pop(0)
-                if point.verify(z, sig):
+            while sec_pubkeys:
+                sec = sec_pubkeys.pop(0)
+                if check_signature(sec, der, z, sig_cache):
                     break
-        stack.append(encode_num(1))
+            else:
+                return False
     except (ValueError, SyntaxError):
         return False
     return True
 
+
+def op_checksigverify(stack, z, sig_cache=None):
+    return op_checksig(stack, z, sig_cache) and op_verify(stack)
+
+
+def op_checkmultisigverify(stack, z, sig_cache=None):
+    return op_checkmultisig(stack, z, sig_cache) and op_verify(stack)
+
+
+# Script.evaluate has no transaction context, so called with the stack
+# alone these only check the operand, as a node does before comparing it
+# with the spending input. Given locktime/sequence they check that too
+def op_checklocktimeverify(stack, locktime=None, sequence=None):
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack[-1])
+    if element < 0:
+        return False
+    if locktime is None:
+        return True
+    if sequence == 0xffffffff:
+        return False
+    if element < 500000000 and locktime > 500000000:
+        return False
+    if element >= 500000000 and locktime < 500000000:
+        return False
+    if locktime < element:
+        return False
+    return True
+
+
+def op_checksequenceverify(stack, version=None, sequence=None):
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack[-1])
+    if element < 0:
+        return False
+    if sequence is None:
+        return True
+    if element & (1 << 31) == (1 << 31):
+        return True
+    if version < 2:
+        return False
+    if sequence & (1 << 31) == (1 << 31):
+        return False
+    if element & (1 << 22) != sequence & (1 << 22):
+        return False
+    if element & 0xffff > sequence & 0xffff:
+        return False
+    return True
+
 OP_CODE_FUNCTIONS = {
     0: op_0,
     79: op_1negate,
@@ -286,4 +953,66 @@ OP_CODE_NAMES = {
     183: 'OP_NOP8',
     184: 'OP_NOP9',
     185: 'OP_NOP10',
-}
\ No newline at end of file
+}
+
+class OpTest(TestCase):
+
+    def test_numbers(self):
+        for num in (0, 1, -1, 127, 128, -128, 255, 2**31 - 1, -2**31):
+            self.assertEqual(decode_num(encode_num(num)), num)
+        stack = [encode_num(7), encode_num(-3)]
+        self.assertTrue(op_sub(stack))
+        self.assertEqual(stack, [encode_num(10)])
+        stack = [encode_num(2), encode_num(1), encode_num(3)]
+        self.assertTrue(op_within(stack))
+        self.assertEqual(stack, [encode_num(1)])
+        self.assertFalse(op_add([encode_num(1)]))
+
+    def test_stack(self):
+        stack = [b'a', b'b', b'c', b'd', b'e', b'f']
+        self.assertTrue(op_2rot(stack))
+        self.assertEqual(stack, [b'c', b'd', b'e', b'f', b'a', b'b'])
+        self.assertTrue(op_2swap(stack))
+        self.assertEqual(stack, [b'c', b'd', b'a', b'b', b'e', b'f'])
+        self.assertTrue(op_tuck(stack))
+        self.assertEqual(stack[-3:], [b'f', b'e', b'f'])
+        stack = [b'x', b'y', b'z', encode_num(2)]
+        self.assertTrue(op_roll(stack))
+        self.assertEqual(stack, [b'y', b'z', b'x'])
+        stack = [b'x', encode_num(1)]
+        self.assertFalse(op_pick(stack))
+
+    def test_if(self):
+        # OP_IF 2 OP_ELSE 3 OP_ENDIF 4
+        for condition, expected in ((encode_num(1), [82, 84]),
+                                    (b'', [83, 84])):
+            items = [82, 103, 83, 104, 84]
+            self.assertTrue(op_if([condition], items))
+            self.assertEqual(items, expected)
+        self.assertFalse(op_if([b''], [82, 103, 83]))
+
+    def test_checksig(self):
+        from secp256k1 import PrivateKey
+        key = PrivateKey(8675309)
+        z = 0xdeadbeef
+        sec = key.point.sec()
+        der = key.sign(z).der() + b'\x01'
+        stack = [der, sec]
+        self.assertTrue(op_checksig(stack, z))
+        self.assertEqual(decode_num(stack[0]), 1)
+        stack = [der, sec]
+        self.assertTrue(op_checksig(stack, z + 1))
+        self.assertEqual(decode_num(stack[0]), 0)
+        self.assertFalse(op_checksigverify([der, sec], z + 1))
+        self.assertFalse(op_checksig([b'\x30\x01', sec], z))
+        # a verified pair re-split at another byte is not a cache hit
+        from sigcache import SignatureCache
+        cache = SignatureCache()
+        self.assertTrue(check_signature(sec, der[:-1], z, cache))
+        self.assertFalse(op_checksig([der[1:], sec + der[:1]], z, cache))
+        other = PrivateKey(1234).point.sec()
+        stack = [b'', der, encode_num(1), other, sec, encode_num(2)]
+        self.assertTrue(op_checkmultisigverify(stack, z))
+        self.assertEqual(stack, [])
+        stack = [b'', der, encode_num(1), other, sec, encode_num(2)]
+        self.assertFalse(op_checkmultisig(stack, z + 1))
@@ -1,8 +1,49 @@
 from helper import (
+    UINT16,
+    UINT32,
+    encode_varint,
     parse_varint,
+    parse_varint_buffer,
     little_endian_to_int,
     int_to_little_endian
     )
+from op_codes import (
+    OP_CODE_FUNCTIONS,
+    OP_CODE_NAMES,
+    decode_num,
+    )
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import Random
+from unittest import TestCase
+from scriptprofile import TEMPLATE_PREFIX, op_name
+from templates import match_template
+import logging
+import sigcache
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# evaluate() runs the compiled program unless told otherwise
+USE_COMPILED = True
+# combined standard scripts skip the interpreter altogether
+USE_TEMPLATES = True
+# (profile, trace) defaults for evaluate(), see instrumented(). A
+# ContextVar so each thread or asyncio task only sees its own
+INSTRUMENTATION = ContextVar('script_instrumentation', default=(None, None))
+
+
+@contextmanager
+def instrumented(profile=None, trace=None):
+    '''Makes every Script.evaluate in the block record into profile (a
+    scriptprofile.ScriptProfile) and/or call trace. Only evaluations in
+    the current context are affected: not other threads, nor worker
+    processes, which should collect their own profile.'''
+    token = INSTRUMENTATION.set((profile, trace))
+    try:
+        yield profile
+    finally:
+        INSTRUMENTATION.reset(token)
 
 class Script:
 
@@ -11,6 +52,11 @@ class Script:
             self.cmds = []
         else:
             self.cmds = cmds
+        # (routine, args) when this is a standard scriptSig + scriptPubKey
+        self.template = None
+        # CompiledScript built by the first compile(). cmds are replaced,
+        # never edited in place, once a script has been evaluated
+        self.compiled = None
 
     def __repr__(self):
         result = []
@@ -25,9 +71,14 @@ class Script:
                 result.append(cmd.hex())
         return ' '.join(result)
 
+    def __add__(self, other):
+        combined = self.__class__(self.cmds + other.cmds)
+        combined.template = match_template(self, other)
+        return combined
+
     @classmethod
     def parse(cls, s):
-        length = read_varint(s)
+        length = parse_varint(s)
         cmds = []
         count = 0
         while count < length:
@@ -46,6 +97,10 @@ class Script:
                 data_length = little_endian_to_int(s.read(2))
                 cmds.append(s.read(data_length))
                 count += data_length + 2
+            elif current_byte == 78:
+                data_length = little_endian_to_int(s.read(4))
+                cmds.append(s.read(data_length))
+                count += data_length + 4
             else:
                 op_code = current_byte
                 cmds.append(op_code)
@@ -53,34 +108,455 @@ class Script:
             raise SyntaxError('parsing script failed')
         return cls(cmds)
 
-    def evaluate(self, z):
+    # Same as parse but reads b (bytes or memoryview) from offset and
+    # returns (script, new offset). Given a memoryview, pushed data stays
+    # a slice of it until materialize() is called
+    @classmethod
+    def parse_buffer(cls, b, offset=0):
+        length, offset = parse_varint_buffer(b, offset)
+        end = offset + length
+        if end > len(b):
+            raise SyntaxError('parsing script failed')
+        cmds = []
+        while offset < end:
+            current_byte = b[offset]
+            offset += 1
+            if current_byte >= 1 and current_byte <= 75:
+                n = current_byte
+            elif current_byte == 76:
+                n = b[offset]
+                offset += 1
+            elif current_byte == 77:
+                n = UINT16.unpack_from(b, offset)[0]
+                offset += 2
+            elif current_byte == 78:
+                n = UINT32.unpack_from(b, offset)[0]
+                offset += 4
+            else:
+                cmds.append(current_byte)
+                continue
+            cmds.append(b[offset:offset + n])
+            offset += n
+        if offset != end:
+            raise SyntaxError('parsing script failed')
+        return cls(cmds), offset
+
+    # Copies buffer slices out, so the buffer they point into can be freed
+    # and the script pickled (memoryviews cannot be)
+    def materialize(self):
+        self.cmds = [cmd if type(cmd) == int else bytes(cmd)
+                     for cmd in self.cmds]
+        self.compiled = None
+        if self.template is not None:
+            routine, args = self.template
+            self.template = routine, tuple(
+                [bytes(item) for item in arg] if type(arg) == list
+                else bytes(arg) for arg in args)
+        return self
+
+    def raw_serialize(self):
+        result = b''
+        for cmd in self.cmds:
+            if type(cmd) == int:
+                result += int_to_little_endian(cmd, 1)
+            else:
+                length = len(cmd)
+                if length <= 75:
+                    result += int_to_little_endian(length, 1)
+                elif length < 0x100:
+                    result += int_to_little_endian(76, 1)
+                    result += int_to_little_endian(length, 1)
+                elif length <= 520:
+                    result += int_to_little_endian(77, 1)
+                    result += int_to_little_endian(length, 2)
+                else:
+                    raise ValueError('too long a cmd')
+                result += cmd
+        return result
+
+    def serialize(self):
+        result = self.raw_serialize()
+        return encode_varint(len(result)) + result
+
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = CompiledScript(self.cmds)
+        return self.compiled
+
+    # sig_cache defaults to the shared sigcache.SIG_CACHE, so a script seen
+    # again (mempool then block, reorgs) skips the signatures it already
+    # checked. Pass SignatureCache(maxsize=0) to always verify.
+    # compiled=True/False forces the compiled runner or the reference
+    # interpreter, skipping templates; left as None, templates and then
+    # USE_COMPILED decide.
+    # profile/trace (or instrumented()) instrument whichever of those runs:
+    # profile gets per-opcode counts and times, trace is called as
+    # trace(pc, cmd, stack, altstack) before every instruction
+    def evaluate(self, z, sig_cache=None, compiled=None, profile=None,
+                 trace=None):
+        if sig_cache is None:
+            sig_cache = sigcache.SIG_CACHE
+        if profile is None or trace is None:
+            active_profile, active_trace = INSTRUMENTATION.get()
+            if profile is None:
+                profile = active_profile
+            if trace is None:
+                trace = active_trace
+        if profile is not None or trace is not None:
+            return self.evaluate_instrumented(z, sig_cache, profile, trace,
+                                              compiled)
+        if compiled is None:
+            if self.template is not None and USE_TEMPLATES:
+                routine, args = self.template
+                return routine(z, sig_cache, *args)
+            compiled = USE_COMPILED
+        if compiled:
+            return self.compile().run(z, sig_cache)
+        return self.interpret(z, sig_cache)
+
+    # Same choice of runner as evaluate(). Templates still run as a single
+    # step unless tracing, which needs every instruction
+    def evaluate_instrumented(self, z, sig_cache, profile, trace,
+                              compiled=None):
+        start = time.perf_counter()
+        if compiled is None and self.template is not None \
+                and USE_TEMPLATES and trace is None:
+            routine, args = self.template
+            valid = routine(z, sig_cache, *args)
+            if profile is not None:
+                profile.record_op(TEMPLATE_PREFIX + routine.__name__,
+                                  time.perf_counter() - start, 0)
+        elif compiled or (compiled is None and USE_COMPILED):
+            valid = self.compile().run_instrumented(z, sig_cache, profile,
+                                                    trace)
+        else:
+            valid = self.interpret(z, sig_cache, profile, trace)
+        if profile is not None:
+            profile.record_script(self, time.perf_counter() - start, valid)
+        return valid
+
+    # Reference interpreter, consumes a copy of cmds one pop at a time.
+    # profile and trace work as in run_instrumented, except that pc counts
+    # the instructions run so far: OP_IF splices its branch back into cmds,
+    # so there is no fixed program counter
+    def interpret(self, z, sig_cache, profile=None, trace=None):
+        clock = time.perf_counter
         cmds = self.cmds[:]
         stack = []
         altstack = []
+        step = 0
         while len(cmds) > 0:
             cmd = cmds.pop(0)
+            if trace is not None:
+                trace(step, cmd, stack, altstack)
+            step += 1
+            if profile is not None:
+                start = clock()
             if type(cmd) == int:
-                operation = OP_CODE_FUNCTIONS[cmd]
-                if cmd in (99, 100):  # <4>
-                    if not operation(stack, cmds):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                operation = OP_CODE_FUNCTIONS.get(cmd)
+                if operation is None:
+                    ok = False
+                elif cmd in (99, 100):  # <4>
+                    ok = operation(stack, cmds)
                 elif cmd in (107, 108):
-                    if not operation(stack, altstack):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                    ok = operation(stack, altstack)
                 elif cmd in (172, 173, 174, 175):
-                    if not operation(stack, z):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                    ok = operation(stack, z, sig_cache)
                 else:
-                    if not operation(stack):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                    ok = operation(stack)
             else:
                 stack.append(cmd)
+                ok = True
+            if profile is not None:
+                profile.record_op(op_name(cmd), clock() - start,
+                                  len(stack) + len(altstack))
+            if not ok:
+                LOGGER.info('bad op: {}'.format(op_name(cmd)))
+                return False
         if len(stack) == 0:
             return False
         if stack.pop() == b'':
             return False
-        return True
\ No newline at end of file
+        return True
+
+
+# Instruction kinds of a compiled script
+PUSH = 0
+OP = 1
+OP_ALTSTACK = 2
+OP_SIG = 3
+IF = 4
+NOTIF = 5
+ELSE = 6
+
+OP_KINDS = {
+    99: IF,
+    100: NOTIF,
+    103: ELSE,
+    107: OP_ALTSTACK,
+    108: OP_ALTSTACK,
+    172: OP_SIG,
+    173: OP_SIG,
+    174: OP_SIG,
+    175: OP_SIG,
+}
+
+
+class CompiledScript:
+    '''Script cmds turned into a flat instruction list for an index loop.
+
+    Each instruction is (kind, handler, cmd, target). The opcode function
+    and its calling convention are resolved here, once. IF/NOTIF carry the
+    index to jump to when the branch is not taken (just past the matching
+    ELSE, or past ENDIF) and ELSE the index past ENDIF, so branches cost
+    a jump instead of the list surgery op_if does. ENDIF itself emits
+    nothing. Unbalanced IF/ELSE/ENDIF make the script invalid.
+    '''
+
+    def __init__(self, cmds):
+        self.valid = True
+        instructions = []
+        # indices of IF/NOTIF/ELSE instructions waiting for their target
+        pending = []
+        for cmd in cmds:
+            if type(cmd) != int:
+                instructions.append((PUSH, None, cmd, None))
+                continue
+            kind = OP_KINDS.get(cmd, OP)
+            if kind in (IF, NOTIF):
+                pending.append(len(instructions))
+                instructions.append([kind, None, cmd, None])
+            elif kind == ELSE:
+                if not pending:
+                    self.valid = False
+                    break
+                # a second ELSE at the same depth stays in the false branch
+                if instructions[pending[-1]][0] == ELSE:
+                    continue
+                branch = pending.pop()
+                pending.append(len(instructions))
+                instructions.append([ELSE, None, cmd, None])
+                instructions[branch][3] = len(instructions)
+            elif cmd == 104:
+                if not pending:
+                    self.valid = False
+                    break
+                instructions[pending.pop()][3] = len(instructions)
+            else:
+                instructions.append(
+                    (kind, OP_CODE_FUNCTIONS.get(cmd), cmd, None))
+        if pending:
+            self.valid = False
+        self.instructions = [tuple(instruction)
+                             for instruction in instructions]
+
+    def run(self, z, sig_cache=None):
+        if not self.valid:
+            LOGGER.info('bad op: unbalanced OP_IF/OP_ELSE/OP_ENDIF')
+            return False
+        instructions = self.instructions
+        end = len(instructions)
+        stack = []
+        altstack = []
+        pc = 0
+        while pc < end:
+            kind, operation, cmd, target = instructions[pc]
+            pc += 1
+            if kind == PUSH:
+                stack.append(cmd)
+                continue
+            if kind == OP:
+                ok = operation is not None and operation(stack)
+            elif kind == OP_SIG:
+                ok = operation is not None and operation(stack, z, sig_cache)
+            elif kind == OP_ALTSTACK:
+                ok = operation is not None and operation(stack, altstack)
+            elif kind == ELSE:
+                pc = target
+                continue
+            else:
+                ok = len(stack) > 0
+                if ok and (decode_num(stack.pop()) == 0) == (kind == IF):
+                    pc = target
+            if not ok:
+                LOGGER.info('bad op: {}'.format(
+                    OP_CODE_NAMES.get(cmd, 'OP_[{}]'.format(cmd))))
+                return False
+        if len(stack) == 0:
+            return False
+        if stack.pop() == b'':
+            return False
+        return True
+
+    # run() with a timer around every instruction. Kept separate so the
+    # plain loop pays nothing for instrumentation
+    def run_instrumented(self, z, sig_cache=None, profile=None, trace=None):
+        if not self.valid:
+            LOGGER.info('bad op: unbalanced OP_IF/OP_ELSE/OP_ENDIF')
+            return False
+        clock = time.perf_counter
+        instructions = self.instructions
+        end = len(instructions)
+        stack = []
+        altstack = []
+        pc = 0
+        while pc < end:
+            kind, operation, cmd, target = instructions[pc]
+            if trace is not None:
+                trace(pc, cmd, stack, altstack)
+            pc += 1
+            start = clock()
+            if kind == PUSH:
+                stack.append(cmd)
+                ok = True
+            elif kind == OP:
+                ok = operation is not None and operation(stack)
+            elif kind == OP_SIG:
+                ok = operation is not None and operation(stack, z, sig_cache)
+            elif kind == OP_ALTSTACK:
+                ok = operation is not None and operation(stack, altstack)
+            elif kind == ELSE:
+                pc = target
+                ok = True
+            else:
+                ok = len(stack) > 0
+                if ok and (decode_num(stack.pop()) == 0) == (kind == IF):
+                    pc = target
+            if profile is not None:
+                profile.record_op(op_name(cmd), clock() - start,
+                                  len(stack) + len(altstack))
+            if not ok:
+                LOGGER.info('bad op: {}'.format(op_name(cmd)))
+                return False
+        if len(stack) == 0:
+            return False
+        if stack.pop() == b'':
+            return False
+        return True
+
+
+class ParseBufferTest(TestCase):
+
+    def parse_both(self, raw):
+        from io import BytesIO
+        script, offset = Script.parse_buffer(memoryview(raw))
+        self.assertEqual(offset, len(raw))
+        expected = Script.parse(BytesIO(raw)).cmds
+        self.assertEqual([cmd if type(cmd) == int else bytes(cmd)
+                          for cmd in script.cmds], expected)
+        return expected
+
+    def test_pushes(self):
+        # direct pushes up to 75 bytes, PUSHDATA1 and PUSHDATA2 either side
+        # of their boundaries, as raw_serialize writes them
+        for length in (1, 75, 76, 255, 256, 520):
+            data = bytes([length % 251]) * length
+            raw = Script([data, 0x76, data]).serialize()
+            self.assertEqual(self.parse_both(raw), [data, 0x76, data])
+        self.assertEqual(Script([b'\x01' * 76]).raw_serialize()[:2],
+                         b'\x4c\x4c')
+        self.assertEqual(Script([b'\x01' * 256]).raw_serialize()[:3],
+                         b'\x4d\x00\x01')
+        # PUSHDATA4, and wider encodings than needed, parse to the data
+        for raw_script in (b'\x4e\x03\x00\x00\x00abc',
+                           b'\x4d\x03\x00abc', b'\x4c\x03abc'):
+            raw = encode_varint(len(raw_script) + 1) + raw_script + b'\x87'
+            self.assertEqual(self.parse_both(raw), [b'abc', 0x87])
+
+    def test_offset(self):
+        raw = Script([b'\x02' * 3, 0xac]).serialize()
+        script, offset = Script.parse_buffer(b'junk' + raw + b'tail', 4)
+        self.assertEqual(script.cmds, [b'\x02' * 3, 0xac])
+        self.assertEqual(offset, 4 + len(raw))
+
+    # cut short in the length varint, the error comes from reading it
+    def test_truncated(self):
+        import struct
+        raw = Script([b'\x01' * 300, 0x76, b'\x02' * 80]).serialize()
+        for cut in range(len(raw)):
+            with self.assertRaises((SyntaxError, IndexError, struct.error)):
+                Script.parse_buffer(memoryview(raw[:cut]))
+        # a push running past the script's declared length
+        with self.assertRaises(SyntaxError):
+            Script.parse_buffer(b'\x02\x05\x01\x00\x00\x00')
+        with self.assertRaises(SyntaxError):
+            Script.parse_buffer(b'\x05\x4e\xff\xff\xff\xff')
+
+
+class CompiledScriptTest(TestCase):
+
+    # pushes and stack/arithmetic ops that can fail, around IF/NOTIF/ELSE
+    # and ENDIF that are sometimes left unbalanced
+    OPS = (0, 81, 82, 105, 117, 118, 124, 135, 145, 147)
+
+    def random_cmds(self, rng, depth=0):
+        cmds = []
+        for _ in range(rng.randrange(1, 5)):
+            choice = rng.random()
+            if choice < 0.25 and depth < 3:
+                if rng.random() < 0.8:
+                    cmds.append(rng.choice((b'', b'\x01', 81, 0)))
+                cmds.append(rng.choice((99, 100)))
+                cmds += self.random_cmds(rng, depth + 1)
+                if rng.random() < 0.6:
+                    cmds.append(103)
+                    cmds += self.random_cmds(rng, depth + 1)
+                cmds.append(104)
+            elif choice < 0.4:
+                cmds.append(bytes([rng.randrange(3)] * rng.randrange(2)))
+            else:
+                cmds.append(rng.choice(self.OPS))
+        return cmds
+
+    def test_matches_interpreter(self):
+        rng = Random(2718)
+        outcomes = set()
+        for _ in range(2000):
+            cmds = self.random_cmds(rng)
+            if rng.random() < 0.1:
+                cmds.insert(rng.randrange(len(cmds) + 1),
+                            rng.choice((99, 100, 103, 104)))
+            script = Script(cmds)
+            expected = script.interpret(0, None)
+            self.assertEqual(script.compile().run(0, None), expected,
+                             repr(script))
+            self.assertEqual(script.evaluate(0, compiled=True), expected)
+            outcomes.add(expected)
+        self.assertEqual(outcomes, {True, False})
+
+    # compiled=True/False pick the runner under profiling and tracing too
+    def test_instrumented_runner(self):
+        from scriptprofile import ScriptProfile
+        cmds = [b'\x01', 99, 81, 103, 0, 104, 0x76, 0x87]
+        for compiled in (True, False):
+            script = Script(cmds)
+            profile = ScriptProfile()
+            steps = []
+
+            def trace(pc, cmd, stack, altstack):
+                steps.append((pc, op_name(cmd)))
+            self.assertTrue(script.evaluate(0, compiled=compiled,
+                                            profile=profile, trace=trace))
+            self.assertEqual(script.compiled is not None, compiled)
+            self.assertEqual(profile.stats()['ops']['OP_DUP']['calls'], 1)
+            self.assertEqual(profile.stats()['scripts'], 1)
+            if compiled:
+                # the jump over OP_ELSE skips to the instruction after it
+                self.assertEqual(steps, [(0, 'PUSH'), (1, 'OP_IF'),
+                                         (2, 'OP_1'), (3, 'OP_ELSE'),
+                                         (5, 'OP_DUP'), (6, 'OP_EQUAL')])
+            else:
+                # OP_IF takes the untaken branch and OP_ENDIF out of cmds
+                self.assertEqual(steps, [(0, 'PUSH'), (1, 'OP_IF'),
+                                         (2, 'OP_1'), (3, 'OP_DUP'),
+                                         (4, 'OP_EQUAL')])
+        self.assertFalse(Script([0x76]).evaluate(0, compiled=False,
+                                                 profile=ScriptProfile()))
+
+    def test_compiled_once(self):
+        script = Script([b'\x01', 99, 81, 103, 0, 104])
+        self.assertIs(script.compile(), script.compile())
+        self.assertTrue(script.evaluate(0))
+        compiled = script.compile()
+        script.materialize()
+        self.assertIsNot(script.compile(), compiled)
@@ -0,0 +1,186 @@
+from op_codes import OP_CODE_NAMES
+from unittest import TestCase
+
+import heapq
+import pickle
+import threading
+
+# pseudo opcode names for pushes and for scripts run by a template routine
+PUSH_NAME = 'PUSH'
+TEMPLATE_PREFIX = 'TEMPLATE:'
+
+
+def op_name(cmd):
+    if type(cmd) != int:
+        return PUSH_NAME
+    return OP_CODE_NAMES.get(cmd, 'OP_[{}]'.format(cmd))
+
+
+class ScriptProfile:
+    '''Per-opcode statistics collected by instrumented Script.evaluate runs.
+
+    For each opcode: calls, cumulative and worst single-call time. For the
+    whole profile: scripts run, failures, the deepest stack seen and the
+    keep_slowest slowest scripts. Scripts matched by a template run as one
+    step, counted under TEMPLATE:<routine>. One profile can collect a
+    whole batch, and profiles from worker processes combine with merge().
+    '''
+
+    def __init__(self, keep_slowest=10):
+        self.keep_slowest = keep_slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    # the lock stays behind when a profile is sent back from a worker
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        # name -> [calls, total time, max time]
+        self.ops = {}
+        self.scripts = 0
+        self.failures = 0
+        self.script_time = 0.0
+        self.max_stack_depth = 0
+        # heap of (time, repr) so the fastest of the kept ones pops first
+        self.slowest = []
+
+    # called for every instruction, so unlocked. Give each thread its own
+    # profile and merge() them
+    def record_op(self, name, elapsed, depth):
+        entry = self.ops.get(name)
+        if entry is None:
+            self.ops[name] = [1, elapsed, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+        if depth > self.max_stack_depth:
+            self.max_stack_depth = depth
+
+    def record_script(self, script, elapsed, valid):
+        with self.lock:
+            self.scripts += 1
+            self.script_time += elapsed
+            if not valid:
+                self.failures += 1
+            if self.keep_slowest > 0:
+                item = (elapsed, repr(script))
+                if len(self.slowest) < self.keep_slowest:
+                    heapq.heappush(self.slowest, item)
+                elif item > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    def merge(self, other):
+        with self.lock:
+            for name, (calls, total, worst) in other.ops.items():
+                entry = self.ops.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] = max(entry[2], worst)
+            self.scripts += other.scripts
+            self.failures += other.failures
+            self.script_time += other.script_time
+            self.max_stack_depth = max(self.max_stack_depth,
+                                       other.max_stack_depth)
+            for item in other.slowest:
+                if len(self.slowest) < self.keep_slowest:
+                    heapq.heappush(self.slowest, item)
+                elif self.slowest and item > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, item)
+        return self
+
+    def stats(self):
+        '''Plain dict for JSON export, opcodes sorted by cumulative time'''
+        with self.lock:
+            ops = sorted(self.ops.items(), key=lambda item: -item[1][1])
+            return {
+                'scripts': self.scripts,
+                'failures': self.failures,
+                'script_time': self.script_time,
+                'max_stack_depth': self.max_stack_depth,
+                'ops': {name: {'calls': calls, 'total_time': total,
+                               'max_time': worst,
+                               'mean_time': total / calls}
+                        for name, (calls, total, worst) in ops},
+                'slowest': [{'time': elapsed, 'script': script}
+                            for elapsed, script in
+                            sorted(self.slowest, reverse=True)],
+            }
+
+
+class ScriptProfileTest(TestCase):
+
+    def test_record_and_merge(self):
+        profile = ScriptProfile(keep_slowest=2)
+        profile.record_op(op_name(0x76), 0.5, 2)
+        profile.record_op(op_name(0x76), 1.5, 3)
+        profile.record_op(op_name(b'\x01'), 0.25, 1)
+        profile.record_script('a', 2.0, True)
+        other = ScriptProfile()
+        other.record_op(op_name(0xac), 3.0, 5)
+        other.record_script('b', 3.0, False)
+        other.record_script('c', 0.1, True)
+        stats = profile.merge(other).stats()
+        self.assertEqual(list(stats['ops']),
+                         ['OP_CHECKSIG', 'OP_DUP', 'PUSH'])
+        self.assertEqual(stats['ops']['OP_DUP'],
+                         {'calls': 2, 'total_time': 2.0, 'max_time': 1.5,
+                          'mean_time': 1.0})
+        self.assertEqual((stats['scripts'], stats['failures']), (3, 1))
+        self.assertEqual(stats['max_stack_depth'], 5)
+        self.assertEqual([s['script'] for s in stats['slowest']],
+                         [repr('b'), repr('a')])
+        copy = pickle.loads(pickle.dumps(profile))
+        self.assertEqual(copy.stats(), stats)
+
+    def test_evaluate(self):
+        from script import Script, instrumented
+        profile = ScriptProfile()
+        steps = []
+
+        def trace(pc, cmd, stack, altstack):
+            steps.append((pc, op_name(cmd), len(stack)))
+
+        script = Script([b'\x02', 0x76, 0x87])
+        with instrumented(profile, trace):
+            self.assertTrue(script.evaluate(0))
+        self.assertTrue(script.evaluate(0))
+        self.assertEqual(steps, [(0, 'PUSH', 0), (1, 'OP_DUP', 1),
+                                 (2, 'OP_EQUAL', 2)])
+        stats = profile.stats()
+        self.assertEqual(stats['scripts'], 1)
+        self.assertEqual(stats['ops']['OP_DUP']['calls'], 1)
+        self.assertEqual(stats['max_stack_depth'], 2)
+
+    def test_instrumented_stays_in_its_thread(self):
+        from script import Script, instrumented
+        profile = ScriptProfile()
+        script = Script([b'\x02', 0x76, 0x87])
+        started = threading.Event()
+        release = threading.Event()
+        other = ScriptProfile()
+
+        def evaluate_elsewhere():
+            with instrumented(other):
+                started.set()
+                release.wait()
+                script.evaluate(0)
+
+        thread = threading.Thread(target=evaluate_elsewhere)
+        thread.start()
+        started.wait()
+        with instrumented(profile):
+            release.set()
+            thread.join()
+            script.evaluate(0)
+        script.evaluate(0)
+        self.assertEqual(profile.stats()['scripts'], 1)
+        self.assertEqual(other.stats()['scripts'], 1)
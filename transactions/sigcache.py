@@ -0,0 +1,184 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from random import randrange
+from unittest import TestCase
+
+import hashlib
+import os
+import threading
+
+EVICTION_POLICIES = ('lru', 'random')
+
+
+class SignatureCache:
+    '''Remembers (pubkey, signature, sighash) triples that verified.
+
+    Only valid signatures are stored, so a hit means the ECDSA check can
+    be skipped. Entries are salted sha256 digests of the triple, 32 bytes
+    each whatever the script sizes, and at most maxsize are kept. When
+    full, 'lru' drops the least recently used entry and 'random' a random
+    one (cheaper, and an attacker cannot predict what gets dropped).
+    '''
+
+    def __init__(self, maxsize=50000, eviction='lru'):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError('unknown eviction policy: {}'.format(eviction))
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.salt = os.urandom(32)
+        self.lock = threading.Lock()
+        # lru keeps recency order, random needs O(1) access by position
+        self.entries = OrderedDict()
+        self.keys = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # list of the triples added while recording(), else None
+        self.added = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Both byte strings are length prefixed, so the same bytes split
+    # differently between pubkey and signature make a different key
+    def key(self, sec_pubkey, der_signature, z):
+        sec_pubkey = bytes(sec_pubkey)
+        der_signature = bytes(der_signature)
+        return hashlib.sha256(self.salt
+                              + len(sec_pubkey).to_bytes(4, 'big')
+                              + sec_pubkey
+                              + len(der_signature).to_bytes(4, 'big')
+                              + der_signature
+                              + z.to_bytes(32, 'big')).digest()
+
+    def contains(self, sec_pubkey, der_signature, z):
+        key = self.key(sec_pubkey, der_signature, z)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            if self.eviction == 'lru':
+                self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, sec_pubkey, der_signature, z):
+        if self.added is not None:
+            self.added.append((bytes(sec_pubkey), bytes(der_signature), z))
+        if self.maxsize <= 0:
+            return
+        key = self.key(sec_pubkey, der_signature, z)
+        with self.lock:
+            if key in self.entries:
+                return
+            while len(self.entries) >= self.maxsize:
+                self.evict()
+            if self.eviction == 'random':
+                self.entries[key] = len(self.keys)
+                self.keys.append(key)
+            else:
+                self.entries[key] = None
+
+    # Keys are salted per cache, so what gets shipped to another process
+    # (a pool worker handing back its results) is the raw triples
+    @contextmanager
+    def recording(self):
+        '''Collects the (sec, der, z) triples added inside the block'''
+        previous, self.added = self.added, []
+        try:
+            yield self.added
+        finally:
+            self.added = previous
+
+    # caller holds the lock
+    def evict(self):
+        if self.eviction == 'lru':
+            self.entries.popitem(last=False)
+        else:
+            # swap the victim with the last key so the list stays dense
+            position = randrange(len(self.keys))
+            victim = self.keys[position]
+            last = self.keys.pop()
+            if last != victim:
+                self.keys[position] = last
+                self.entries[last] = position
+            del self.entries[victim]
+        self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys = []
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# shared by every Script.evaluate that is not handed its own cache
+SIG_CACHE = SignatureCache()
+
+
+class SignatureCacheTest(TestCase):
+
+    def test_contains(self):
+        cache = SignatureCache(maxsize=10)
+        self.assertFalse(cache.contains(b'\x02' * 33, b'\x30', 1))
+        cache.add(b'\x02' * 33, b'\x30', 1)
+        self.assertTrue(cache.contains(b'\x02' * 33, b'\x30', 1))
+        self.assertFalse(cache.contains(b'\x02' * 33, b'\x30', 2))
+        self.assertFalse(cache.contains(b'\x03' * 33, b'\x30', 1))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_fields_are_framed(self):
+        cache = SignatureCache(maxsize=10)
+        sec, der = b'\x02' * 33, b'\x30\x06' + b'\x01' * 6
+        cache.add(sec, der, 1)
+        self.assertTrue(cache.contains(sec, der, 1))
+        self.assertFalse(cache.contains(sec + der[:1], der[1:], 1))
+        self.assertFalse(cache.contains(sec[:-1], sec[-1:] + der, 1))
+
+    def test_eviction(self):
+        for eviction in EVICTION_POLICIES:
+            cache = SignatureCache(maxsize=3, eviction=eviction)
+            for z in range(10):
+                cache.add(b'\x02' * 33, b'\x30', z)
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(cache.stats()['evictions'], 7)
+            self.assertTrue(cache.contains(b'\x02' * 33, b'\x30', 9))
+        cache = SignatureCache(maxsize=2, eviction='lru')
+        cache.add(b'', b'', 1)
+        cache.add(b'', b'', 2)
+        cache.contains(b'', b'', 1)
+        cache.add(b'', b'', 3)
+        self.assertTrue(cache.contains(b'', b'', 1))
+        self.assertFalse(cache.contains(b'', b'', 2))
+
+    def test_recording(self):
+        cache = SignatureCache(maxsize=10)
+        cache.add(b'\x02' * 33, b'\x30', 1)
+        with cache.recording() as added:
+            cache.add(b'\x03' * 33, memoryview(b'\x30'), 2)
+        cache.add(b'\x02' * 33, b'\x30', 3)
+        self.assertEqual(added, [(b'\x03' * 33, b'\x30', 2)])
+        other = SignatureCache(maxsize=10)
+        for entry in added:
+            other.add(*entry)
+        self.assertTrue(other.contains(b'\x03' * 33, b'\x30', 2))
+
+    def test_disabled(self):
+        cache = SignatureCache(maxsize=0)
+        cache.add(b'', b'', 1)
+        self.assertFalse(cache.contains(b'', b'', 1))
+        with self.assertRaises(ValueError):
+            SignatureCache(eviction='fifo')
@@ -0,0 +1,169 @@
+from helper import hash160
+from op_codes import check_multisig, check_signature
+from unittest import TestCase
+
+# Direct validation of the standard script pairs. match_template() looks
+# at a scriptSig/scriptPubKey pair once, when they are combined, and the
+# routine it returns reaches the same verdict as running the combined
+# script through the interpreter, without the stack machine.
+
+
+def is_push(cmd):
+    return type(cmd) != int
+
+
+def is_push_op(cmd):
+    '''a data push, OP_0 or OP_1..OP_16'''
+    return is_push(cmd) or cmd == 0 or small_int(cmd) is not None
+
+
+def small_int(cmd):
+    '''OP_1..OP_16 as a number, None for anything else'''
+    if type(cmd) == int and 81 <= cmd <= 96:
+        return cmd - 80
+    return None
+
+
+# <sig> <sec> | OP_DUP OP_HASH160 <h160> OP_EQUALVERIFY OP_CHECKSIG
+def evaluate_p2pkh(z, sig_cache, sig, sec, h160):
+    if hash160(sec) != h160:
+        return False
+    try:
+        return check_signature(sec, sig[:-1], z, sig_cache)
+    except (ValueError, SyntaxError):
+        return False
+
+
+# <pushes...> <redeem script> | OP_HASH160 <h160> OP_EQUAL
+def evaluate_p2sh(z, sig_cache, redeem_script, h160):
+    return hash160(redeem_script) == h160
+
+
+# OP_0 <sig>... | OP_m <sec>... OP_n OP_CHECKMULTISIG
+def evaluate_multisig(z, sig_cache, sigs, secs):
+    # op_checkmultisig pops from the top, so it sees both lists reversed
+    return check_multisig(secs[::-1], [sig[:-1] for sig in sigs[::-1]],
+                          z, sig_cache)
+
+
+def match_template(script_sig, script_pubkey):
+    '''(routine, args) for a standard pair, None for anything else.
+    The routine is called as routine(z, sig_cache, *args)'''
+    sig_cmds = script_sig.cmds
+    cmds = script_pubkey.cmds
+    if not all(is_push_op(cmd) for cmd in sig_cmds):
+        return None
+    if len(cmds) == 5 and cmds[0] == 0x76 and cmds[1] == 0xa9 \
+            and is_push(cmds[2]) and len(cmds[2]) == 20 \
+            and cmds[3] == 0x88 and cmds[4] == 0xac:
+        if len(sig_cmds) == 2 and all(is_push(cmd) for cmd in sig_cmds):
+            return evaluate_p2pkh, (sig_cmds[0], sig_cmds[1], cmds[2])
+        return None
+    # the usual P2SH multisig scriptSig starts with OP_0
+    if len(cmds) == 3 and cmds[0] == 0xa9 and is_push(cmds[1]) \
+            and len(cmds[1]) == 20 and cmds[2] == 0x87:
+        if len(sig_cmds) >= 1 and is_push(sig_cmds[-1]):
+            return evaluate_p2sh, (sig_cmds[-1], cmds[1])
+        return None
+    if len(cmds) >= 4 and cmds[-1] == 0xae:
+        m = small_int(cmds[0])
+        n = small_int(cmds[-2])
+        secs = cmds[1:-2]
+        if m is None or n is None or len(secs) != n \
+                or not all(is_push(sec) for sec in secs):
+            return None
+        if len(sig_cmds) == m + 1 and sig_cmds[0] == 0 \
+                and all(is_push(sig) for sig in sig_cmds[1:]):
+            return evaluate_multisig, (sig_cmds[1:], secs)
+    return None
+
+
+class TemplateTest(TestCase):
+
+    def setUp(self):
+        from secp256k1 import PrivateKey
+        from sigcache import SignatureCache
+        self.keys = [PrivateKey(secret) for secret in (101, 202, 303)]
+        self.z = 0x1234567890
+        self.sig_cache = SignatureCache(maxsize=0)
+
+    def sig(self, key, z=None):
+        return key.sign(self.z if z is None else z).der() + b'\x01'
+
+    # the template routine, the compiled runner and the interpreter all
+    # reach the same verdict
+    def check(self, script_sig, script_pubkey, expected, routine):
+        from scriptprofile import TEMPLATE_PREFIX, ScriptProfile
+        combined = script_sig + script_pubkey
+        self.assertIs(combined.template[0], routine)
+        self.assertEqual(combined.evaluate(self.z, self.sig_cache), expected)
+        self.assertEqual(combined.evaluate(self.z, self.sig_cache,
+                                           compiled=True), expected)
+        self.assertEqual(combined.evaluate(self.z, self.sig_cache,
+                                           compiled=False), expected)
+        self.assertEqual(combined.interpret(self.z, self.sig_cache), expected)
+        # a profile sees the template only when neither runner is forced
+        for compiled in (None, True, False):
+            profile = ScriptProfile()
+            self.assertEqual(combined.evaluate(self.z, self.sig_cache,
+                                               compiled, profile), expected)
+            ops = profile.stats()['ops']
+            self.assertEqual(TEMPLATE_PREFIX + routine.__name__ in ops,
+                             compiled is None)
+
+    def test_p2pkh(self):
+        from script import Script
+        key, other = self.keys[:2]
+        sec = key.point.sec()
+        script_pubkey = Script([0x76, 0xa9, key.point.hash160(), 0x88, 0xac])
+        cases = (
+            ([self.sig(key), sec], True),
+            ([self.sig(key, self.z + 1), sec], False),
+            ([self.sig(other), sec], False),
+            ([self.sig(other), other.point.sec()], False),
+            ([b'\x30\x01\x01', sec], False),
+        )
+        for cmds, expected in cases:
+            self.check(Script(cmds), script_pubkey, expected, evaluate_p2pkh)
+
+    def test_multisig(self):
+        from script import Script
+        secs = [key.point.sec() for key in self.keys]
+        script_pubkey = Script([82] + secs + [83, 0xae])
+        a, b, c = [self.sig(key) for key in self.keys]
+        cases = (
+            ([0, a, b], True),
+            ([0, a, c], True),
+            ([0, b, c], True),
+            ([0, b, a], False),
+            ([0, a, a], False),
+            ([0, a, self.sig(self.keys[1], self.z + 1)], False),
+            ([0, a, b'\x30\x01\x01'], False),
+        )
+        for cmds, expected in cases:
+            self.check(Script(cmds), script_pubkey, expected,
+                       evaluate_multisig)
+
+    def test_p2sh(self):
+        from script import Script
+        redeem_script = Script([81]).raw_serialize()
+        script_pubkey = Script([0xa9, hash160(redeem_script), 0x87])
+        self.check(Script([b'\x01', redeem_script]), script_pubkey, True,
+                   evaluate_p2sh)
+        self.check(Script([b'\x01', redeem_script + b'\x00']),
+                   script_pubkey, False, evaluate_p2sh)
+
+    def test_p2sh_multisig(self):
+        from script import Script
+        secs = [key.point.sec() for key in self.keys]
+        redeem_script = Script([82] + secs + [83, 0xae]).raw_serialize()
+        script_pubkey = Script([0xa9, hash160(redeem_script), 0x87])
+        sigs = [self.sig(key) for key in self.keys[:2]]
+        self.check(Script([0] + sigs + [redeem_script]), script_pubkey, True,
+                   evaluate_p2sh)
+        self.check(Script([0, 81, redeem_script]), script_pubkey, True,
+                   evaluate_p2sh)
+        self.check(Script([0] + sigs + [redeem_script[1:]]), script_pubkey,
+                   False, evaluate_p2sh)
+        combined = Script([0, 0x76, redeem_script]) + script_pubkey
+        self.assertIsNone(combined.template)
@@ -1,31 +1,56 @@
+from concurrent.futures import (
+        ProcessPoolExecutor,
+        ThreadPoolExecutor,
+        as_completed,
+    )
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+import asyncio
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import requests
 from helper import (
+        LRUCache,
+        UINT32,
+        UINT64,
+        encode_varint,
         hash256,
         little_endian_to_int,
         int_to_little_endian,
         parse_varint,
+        parse_varint_buffer,
     )
+from script import Script
+from scriptprofile import ScriptProfile
+
+import sigcache
+
+SIGHASH_ALL = 1
 
 class Tx:
 
-    def __init__(self, version, tx_in, tx_out, locktime, testnet=True):
+    def __init__(self, version, tx_ins, tx_outs, locktime, testnet=True):
         self.version = version
-        self.tx_in = tx_in
-        self.tx_out = tx_out
+        self.tx_ins = tx_ins
+        self.tx_outs = tx_outs
         self.locktime = locktime
         self.testnet = testnet
 
     def id(self):
-        self.hash().hex()
+        return self.hash().hex()
 
     def hash(self):
         return hash256(self.serialize())[::-1]
 
     def __repr__(self):
         tx_ins = ''
-        for tx in self.tx_in:
+        for tx in self.tx_ins:
             tx_ins += tx.__repr__() + '\n'
         tx_outs = ''
-        for tx in self.tx_out:
+        for tx in self.tx_outs:
             tx_outs += tx.__repr__() + '\n'
         return 'id:{}\nversion:{}\ntx_ins:{}\ntx_outs:{}\nlocktime:{}'.format(
                 self.id,
@@ -34,6 +59,7 @@ class Tx:
                 tx_outs,
                 self.locktime)
 
+    @classmethod
     def parse(cls, s, testnet=False):
         version = little_endian_to_int(s.read(4))
         num_inputs = parse_varint(s)
@@ -43,10 +69,44 @@ class Tx:
         num_outputs = parse_varint(s)
         outputs = []
         for _ in range(num_outputs):
-            outputs.append(TxIn.parse(s))
+            outputs.append(TxOut.parse(s))
         locktime = little_endian_to_int(s.read(4))
         return cls(version, inputs, outputs, locktime, testnet=testnet)
 
+    # Parses straight out of a bytes/memoryview buffer with an offset
+    # cursor instead of a stream: no read() call or bytes object per
+    # field. Returns (tx, offset just past it) so buffers holding many
+    # transactions can be walked. Wrap raw bytes in a memoryview to keep
+    # script pushes as zero-copy slices.
+    # Segwit transactions (marker 0x00, flag 0x01) are accepted and their
+    # witness data skipped, the Tx keeps the legacy fields only
+    @classmethod
+    def parse_buffer(cls, b, offset=0, testnet=False):
+        version = UINT32.unpack_from(b, offset)[0]
+        offset += 4
+        segwit = b[offset] == 0 and b[offset + 1] == 1
+        if segwit:
+            offset += 2
+        num_inputs, offset = parse_varint_buffer(b, offset)
+        inputs = []
+        for _ in range(num_inputs):
+            tx_in, offset = TxIn.parse_buffer(b, offset)
+            inputs.append(tx_in)
+        num_outputs, offset = parse_varint_buffer(b, offset)
+        outputs = []
+        for _ in range(num_outputs):
+            tx_out, offset = TxOut.parse_buffer(b, offset)
+            outputs.append(tx_out)
+        if segwit:
+            for _ in range(num_inputs):
+                num_items, offset = parse_varint_buffer(b, offset)
+                for _ in range(num_items):
+                    length, offset = parse_varint_buffer(b, offset)
+                    offset += length
+        locktime = UINT32.unpack_from(b, offset)[0]
+        tx = cls(version, inputs, outputs, locktime, testnet=testnet)
+        return tx, offset + 4
+
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
         result += encode_varint(len(self.tx_ins))
@@ -66,58 +126,215 @@ class Tx:
             output_sum += tx_out.amount
         return input_sum - output_sum
 
-    def sig_hash(self, input_index):
-        s = int_to_little_endian(self.version, 4)
-        s += encode_varint(len(self.tx_ins))
-        for i, tx_in in enumerate(self.tx_ins):
-            if i == input_index:
-                s += TxIn(
-                    prev_tx=tx_in.prev_tx,
-                    prev_index=tx_in.prev_index,
-                    script_sig=tx_in.script_pubkey(self.testnet),
-                    sequence=tx_in.sequence,
-                ).serialize()
-            else:
-                s += TxIn(
-                    prev_tx=tx_in.prev_tx,
-                    prev_index=tx_in.prev_index,
-                    sequence=tx_in.sequence,
-                ).serialize()
-        s += encode_varint(len(self.tx_outs))
-        for tx_out in self.tx_outs:
-            s += tx_out.serialize()
-        s += int_to_little_endian(self.locktime, 4)
-        s += int_to_little_endian(SIGHASH_ALL, 4)
-        h256 = hash256(s)
-        return int.from_bytes(h256, 'big')
+    def sighash_context(self):
+        return SigHashContext(self)
 
-    def verify_input(self, input_index):
+    # Pass a context from sighash_context() when hashing several inputs of
+    # the same tx, so the shared parts are serialized only once
+    def sig_hash(self, input_index, context=None):
+        if context is None:
+            context = SigHashContext(self)
+        return context.sig_hash(input_index)
+
+    # The (script, z) pair that verify_input evaluates. Everything that
+    # needs the network or the whole tx happens here, so the pair alone
+    # can be shipped to a worker process once the script is materialized
+    def input_job(self, input_index, context=None):
         tx_in = self.tx_ins[input_index]
         script_pubkey = tx_in.script_pubkey(testnet=self.testnet)
-        z = self.sig_hash(input_index)
+        z = self.sig_hash(input_index, context)
         combined = tx_in.script_sig + script_pubkey
-        return combined.evaluate(z)
+        return combined, z
+
+    def verify_input(self, input_index, context=None, profile=None):
+        return evaluate_jobs([self.input_job(input_index, context)], profile)
 
-    def verify(self):
-        '''Verify this transaction'''
-        if self.fee() < 0:  1
+    def verify(self, workers=None, prefetch=True, profile=None,
+               executor=None):
+        '''Verify this transaction. With workers > 1 the input scripts are
+        evaluated in a process pool of that size, or in executor when one
+        is given so a pool can be reused across calls. Unless prefetch is
+        off, all previous transactions are fetched concurrently first. A
+        scriptprofile.ScriptProfile given as profile collects the stats of
+        every input script'''
+        if prefetch:
+            prefetch_transactions([self], testnet=self.testnet)
+        try:
+            if self.fee() < 0:
+                return False
+        except KeyError:
+            # spends an output the UTXO set does not have
             return False
+        context = self.sighash_context()
+        parallel = executor is not None or (workers is not None
+                                            and workers > 1)
+        if parallel and len(self.tx_ins) > 1:
+            jobs = [self.input_job(i, context) for i in range(len(self.tx_ins))]
+            return evaluate_jobs_parallel(jobs, workers, profile, executor)
         for i in range(len(self.tx_ins)):
-            if not self.verify_input(i):  2
+            if not self.verify_input(i, context, profile):
                 return False
         return True
 
-     def sign_input(self, input_index, private_key):
-        z = self.sig_hash(input_index)
+    # scriptSigs are blanked in the legacy sighash, so one context stays
+    # valid while the inputs are signed one after another
+    def sign_input(self, input_index, private_key, context=None):
+        if context is None:
+            context = self.sighash_context()
+        z = self.sig_hash(input_index, context)
         der = private_key.sign(z).der()
         sig = der + SIGHASH_ALL.to_bytes(1, 'big')
         sec = private_key.point.sec()
         self.tx_ins[input_index].script_sig = Script([sig, sec])
-        return self.verify_input(input_index)
+        return self.verify_input(input_index, context)
+
+
+class SigHashContext:
+    '''Shared pieces of the SIGHASH_ALL preimages of one transaction.
+
+    The preimage for input i is version, every input with an empty
+    scriptSig except input i which carries its scriptPubKey, the outputs,
+    locktime and hash type. All of it except input i's script is the same
+    for every i, so it is serialized once here. The sha256 state after
+    the inputs before i is also kept for each i, so hashing input i only
+    has to feed input i and what follows it.
+
+    That removes the repeated serialization, not the quadratic hashing
+    built into legacy SIGHASH_ALL: each preimage still holds every input
+    after i, so signing or verifying all N inputs hashes O(N^2) bytes,
+    about half of what hashing every full preimage would.
+    '''
+
+    def __init__(self, tx):
+        self.tx = tx
+        outpoints = []
+        sequences = []
+        for tx_in in tx.tx_ins:
+            outpoints.append(tx_in.prev_tx[::-1]
+                             + int_to_little_endian(tx_in.prev_index, 4))
+            sequences.append(int_to_little_endian(tx_in.sequence, 4))
+        self.outpoints = outpoints
+        self.sequences = sequences
+        blank_inputs = [outpoint + b'\x00' + sequence
+                        for outpoint, sequence in zip(outpoints, sequences)]
+        outputs = encode_varint(len(tx.tx_outs))
+        outputs += b''.join(tx_out.serialize() for tx_out in tx.tx_outs)
+        outputs += int_to_little_endian(tx.locktime, 4)
+        outputs += int_to_little_endian(SIGHASH_ALL, 4)
+        # body is every blank input followed by the outputs part;
+        # offsets[i] is where blank input i starts inside it
+        self.body = memoryview(b''.join(blank_inputs) + outputs)
+        self.offsets = [0]
+        for blank in blank_inputs:
+            self.offsets.append(self.offsets[-1] + len(blank))
+        self.prefix = int_to_little_endian(tx.version, 4) \
+            + encode_varint(len(tx.tx_ins))
+        self.states = None
+
+    def prefix_states(self):
+        if self.states is None:
+            running = hashlib.sha256(self.prefix)
+            states = []
+            for i in range(len(self.outpoints)):
+                states.append(running.copy())
+                running.update(self.body[self.offsets[i]:self.offsets[i + 1]])
+            self.states = states
+        return self.states
+
+    def sig_hash(self, input_index, script_pubkey=None):
+        if script_pubkey is None:
+            tx_in = self.tx.tx_ins[input_index]
+            script_pubkey = tx_in.script_pubkey(self.tx.testnet)
+        s = self.prefix_states()[input_index].copy()
+        s.update(self.outpoints[input_index])
+        s.update(script_pubkey.serialize())
+        s.update(self.sequences[input_index])
+        s.update(self.body[self.offsets[input_index + 1]:])
+        h256 = hashlib.sha256(s.digest()).digest()
+        return int.from_bytes(h256, 'big')
+
+
+def evaluate_jobs(jobs, profile=None):
+    for script, z in jobs:
+        if not script.evaluate(z, profile=profile):
+            return False
+    return True
+
+
+# worker side of evaluate_jobs_parallel: the verdict, the signatures the
+# worker's cache took in and the chunk's profile (None when not profiling)
+def evaluate_chunk(jobs, profiled=False):
+    profile = ScriptProfile() if profiled else None
+    with sigcache.SIG_CACHE.recording() as added:
+        valid = evaluate_jobs(jobs, profile)
+    return valid, added, profile
+
+
+# Script evaluation is pure-Python EC math, so threads would just queue on
+# the GIL. Jobs go to worker processes in chunks, a few per worker, and the
+# first failing chunk cancels whatever has not started yet. Signatures a
+# worker verified are added to the shared cache here, so they are not
+# checked again in this process. With a profile, each chunk is profiled in
+# its worker and merged in here. Scripts from parse_buffer are materialized
+# first, their memoryview pushes cannot be pickled. A pool passed as
+# executor is used and left running; otherwise one is started and shut
+# down without waiting on chunks that are still running.
+def evaluate_jobs_parallel(jobs, workers=None, profile=None, executor=None):
+    if not jobs:
+        return True
+    jobs = [(script.materialize(), z) for script, z in jobs]
+    workers = workers or os.cpu_count() or 1
+    chunk_size = -(-len(jobs) // (workers * 4))
+    owned = executor is None
+    if owned:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        futures = [executor.submit(evaluate_chunk, jobs[i:i + chunk_size],
+                                   profile is not None)
+                   for i in range(0, len(jobs), chunk_size)]
+        for future in as_completed(futures):
+            valid, added, chunk_profile = future.result()
+            for entry in added:
+                sigcache.SIG_CACHE.add(*entry)
+            if profile is not None:
+                profile.merge(chunk_profile)
+            if not valid:
+                return False
+        return True
+    finally:
+        for future in futures:
+            future.cancel()
+        if owned:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def verify_transactions(txs, workers=None, prefetch=True, profile=None,
+                        executor=None):
+    '''Verifies a batch of transactions, spreading every input of every
+    transaction over one process pool, executor if given. False as soon as
+    any input fails'''
+    if prefetch:
+        prefetch_transactions(txs)
+    jobs = []
+    for tx in txs:
+        try:
+            if tx.fee() < 0:
+                return False
+        except KeyError:
+            return False
+        context = tx.sighash_context()
+        jobs += [tx.input_job(i, context) for i in range(len(tx.tx_ins))]
+    return evaluate_jobs_parallel(jobs, workers, profile, executor)
 
 
 class TxIn:
 
+    # optional utxo.UtxoSet. When set, amounts and scriptPubKeys of the
+    # outputs being spent come from it instead of the fetched prev tx, and
+    # it is authoritative: an output it does not hold is missing or spent
+    utxo_set = None
+
     def __init__(self, prev_tx, prev_index, script_sig=None,
                  sequence=0xffffffff):
         self.prev_tx = prev_tx
@@ -133,7 +350,23 @@ class TxIn:
                 self.prev_tx.hex(),
                 self.prev_index)
 
-    def serialze(self):
+    @classmethod
+    def parse(cls, s):
+        prev_tx = s.read(32)[::-1]
+        prev_index = little_endian_to_int(s.read(4))
+        script_sig = Script.parse(s)
+        sequence = little_endian_to_int(s.read(4))
+        return cls(prev_tx, prev_index, script_sig, sequence)
+
+    @classmethod
+    def parse_buffer(cls, b, offset=0):
+        prev_tx = bytes(b[offset:offset + 32])[::-1]
+        prev_index = UINT32.unpack_from(b, offset + 32)[0]
+        script_sig, offset = Script.parse_buffer(b, offset + 36)
+        sequence = UINT32.unpack_from(b, offset)[0]
+        return cls(prev_tx, prev_index, script_sig, sequence), offset + 4
+
+    def serialize(self):
         result = self.prev_tx[::-1]
         result += int_to_little_endian(self.prev_index, 4)
         result += self.script_sig.serialize()
@@ -141,11 +374,25 @@ class TxIn:
         return result
 
     def fetch_tx(self, testnet=False):
-        return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
+        return Fetcher.fetch(self.prev_tx.hex(), testnet=testnet)
 
-    def get_amount(self, testnet=False):
+    # the TxOut this input spends. KeyError when a UTXO set is configured
+    # and does not hold it, never a network fetch
+    def prev_output(self, testnet=False):
+        if self.utxo_set is not None:
+            tx_out = self.utxo_set.get(self.prev_tx, self.prev_index)
+            if tx_out is None:
+                raise KeyError('missing or spent output {}:{}'.format(
+                    self.prev_tx.hex(), self.prev_index))
+            return tx_out
         tx = self.fetch_tx(testnet=testnet)
-        return tx.tx_outs[self.prev_index].amount
+        return tx.tx_outs[self.prev_index]
+
+    def get_amount(self, testnet=False):
+        return self.prev_output(testnet=testnet).amount
+
+    def script_pubkey(self, testnet=False):
+        return self.prev_output(testnet=testnet).script_pubkey
 
 
 class TxOut:
@@ -157,49 +404,515 @@ class TxOut:
     def __repr__(self):
         return '{} : {}'.format(self.amount, self.script_pubkey)
 
-    def script_pubkey(self, testnet=False):
-        tx = self.fetch_tx(testnet=testnet)
-        return tx.tx_outs[self.prev_index].script_pubkey
-
     @classmethod
     def parse(cls, s):
         amount = little_endian_to_int(s.read(8))
         script_pubkey = Script.parse(s)
         return cls(amount, script_pubkey)
 
+    @classmethod
+    def parse_buffer(cls, b, offset=0):
+        amount = UINT64.unpack_from(b, offset)[0]
+        script_pubkey, offset = Script.parse_buffer(b, offset + 8)
+        return cls(amount, script_pubkey), offset
+
     def serialize(self):
         result = int_to_little_endian(self.amount, 8)
         result += self.script_pubkey.serialize()
         return result
 
+class TxStore:
+    '''Raw transactions in a local sqlite file, keyed by txid.
+
+    Survives restarts, so a process does not have to refetch every
+    previous transaction it ever looked at. With max_entries set, the
+    oldest stored transactions are dropped first once it is exceeded.
+    '''
+
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS txs '
+                        '(txid TEXT PRIMARY KEY, raw BLOB NOT NULL)')
+        self.db.commit()
+        self.count = self.db.execute('SELECT COUNT(*) FROM txs').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return self.count
+
+    # existence check that leaves the hit/miss counters alone
+    def contains(self, tx_id):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM txs WHERE txid = ?',
+                                   (tx_id,)).fetchone() is not None
+
+    def get(self, tx_id):
+        with self.lock:
+            row = self.db.execute('SELECT raw FROM txs WHERE txid = ?',
+                                  (tx_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, tx_id, raw):
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO txs (txid, raw) VALUES (?, ?)',
+                (tx_id, raw))
+            self.count += cursor.rowcount
+            if self.max_entries is not None and self.count > self.max_entries:
+                excess = self.count - self.max_entries
+                self.db.execute('DELETE FROM txs WHERE rowid IN (SELECT rowid '
+                                'FROM txs ORDER BY rowid LIMIT ?)', (excess,))
+                self.count -= excess
+                self.evictions += excess
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': self.count,
+            'maxsize': self.max_entries,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
 class Fetcher:
+    '''Previous transactions by txid, through two cache tiers.
+
+    cache holds parsed Tx objects in a bounded in-memory LRU. store, when
+    configured, is a TxStore holding the raw bytes on disk. Only misses
+    in both go to the network, and whatever comes back fills both.
+    lookups counts fetch() calls and memory_hits/store_hits the ones each
+    tier answered. network_fetches counts downloads, prefetched included.
+    '''
 
-    cache = {}
+    cache = LRUCache(maxsize=1024)
+    store = None
+    lookups = 0
+    memory_hits = 0
+    store_hits = 0
+    network_fetches = 0
+    urls = {
+        False: 'http://mainnet.programmingbitcoin.com',
+        True: 'http://testnet.programmingbitcoin.com',
+    }
+    # keep-alive connections shared by every fetch, sized for prefetching
+    session = None
+    pool_size = 16
 
     @classmethod
-    def get_url(cls, test_net=False):
-        if testnet:
-            return 'http://testnet.programmingbitcoin.com'
+    def configure(cls, memory_size=1024, store_path=None, store_size=None):
+        cls.cache = LRUCache(maxsize=memory_size)
+        if cls.store is not None:
+            cls.store.close()
+        if store_path is None:
+            cls.store = None
         else:
-            return 'http://mainnet.programmingbitcoin.com'
+            cls.store = TxStore(store_path, max_entries=store_size)
+        cls.lookups = cls.memory_hits = cls.store_hits = 0
+        cls.network_fetches = 0
+
+    @classmethod
+    def get_url(cls, testnet=False):
+        return cls.urls[bool(testnet)]
+
+    @classmethod
+    def get_session(cls):
+        if cls.session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=2, pool_maxsize=cls.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls.session = session
+        return cls.session
 
+    @classmethod
+    def fetch_raw(cls, tx_id, testnet=False):
+        url = '{}/tx/{}.hex'.format(cls.get_url(testnet), tx_id)
+        response = cls.get_session().get(url)
+        try:
+            return bytes.fromhex(response.text.strip())
+        except ValueError:
+            raise ValueError('unexpected response: {}'.format(response.text))
+
+    @classmethod
+    def parse_raw(cls, tx_id, raw, testnet=False):
+        tx, _ = Tx.parse_buffer(raw, testnet=testnet)
+        if tx.id() != tx_id:
+            raise ValueError('not the same id: {} vs {}'.format(tx.id(),
+                              tx_id))
+        return tx
+
+    @classmethod
     def fetch(cls, tx_id, testnet=False, fresh=False):
-        if fresh or (tx_id not in cache):
-            url = '{}/tx/{}.hex'.format(cls.get_url(testnet), tx_id)
-            response = requests.get(url)
-            try:
-                raw = bytes.fromhex(response.text.strip())
-            except ValueError:
-                raise ValueError('unexpected response: {}'.format(response.text))
-            if raw[4] == 0:
-                raw = raw[:4] + raw[6:]
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
-                tx.locktime = little_endian_to_int(raw[-4:])
-            else:
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
-            if tx.id() != tx_id:  1
-                raise ValueError('not the same id: {} vs {}'.format(tx.id(),
-                                  tx_id))
-            cls.cache[tx_id] = tx
-        cls.cache[tx_id].testnet = testnet
-        return cls.cache[tx_id]
+        cls.lookups += 1
+        tx = None
+        if not fresh:
+            tx = cls.cache.get(tx_id)
+            if tx is not None:
+                cls.memory_hits += 1
+            elif cls.store is not None:
+                raw = cls.store.get(tx_id)
+                if raw is not None:
+                    cls.store_hits += 1
+                    tx = cls.parse_raw(tx_id, raw, testnet=testnet)
+                    cls.cache.put(tx_id, tx)
+        if tx is None:
+            tx = cls.add(tx_id, cls.fetch_raw(tx_id, testnet=testnet),
+                         testnet=testnet)
+        tx.testnet = testnet
+        return tx
+
+    # a raw tx that just came off the network, into both tiers
+    @classmethod
+    def add(cls, tx_id, raw, testnet=False):
+        cls.network_fetches += 1
+        tx = cls.parse_raw(tx_id, raw, testnet=testnet)
+        cls.cache.put(tx_id, tx)
+        if cls.store is not None:
+            cls.store.put(tx_id, raw)
+        return tx
+
+    @classmethod
+    def is_cached(cls, tx_id):
+        if tx_id in cls.cache:
+            return True
+        return cls.store is not None and cls.store.contains(tx_id)
+
+    @classmethod
+    def stats(cls):
+        hits = cls.memory_hits + cls.store_hits
+        return {
+            'memory': cls.cache.stats(),
+            'store': cls.store.stats() if cls.store is not None else None,
+            'lookups': cls.lookups,
+            'memory_hits': cls.memory_hits,
+            'store_hits': cls.store_hits,
+            'network_fetches': cls.network_fetches,
+            # share of fetch() calls answered without the network
+            'hit_rate': hits / cls.lookups if cls.lookups else 0.0,
+        }
+
+
+async def prefetch_async(tx_ids, testnet=False, concurrency=16):
+    '''Fetches every tx_id not already cached, at most concurrency at a
+    time, and adds them to the Fetcher tiers. Duplicates are fetched once.
+
+    requests has no asyncio interface, so each download runs on a thread
+    of a pool as wide as the concurrency limit, sharing the keep-alive
+    connections of Fetcher.session.
+    '''
+    pending = []
+    for tx_id in dict.fromkeys(tx_ids):
+        if not Fetcher.is_cached(tx_id):
+            pending.append(tx_id)
+    if not pending:
+        return 0
+    loop = asyncio.get_running_loop()
+    Fetcher.get_session()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def fetch_one(tx_id):
+            raw = await loop.run_in_executor(executor, Fetcher.fetch_raw,
+                                             tx_id, testnet)
+            Fetcher.add(tx_id, raw, testnet=testnet)
+
+        await asyncio.gather(*(fetch_one(tx_id) for tx_id in pending))
+    return len(pending)
+
+
+def prefetch_transactions(txs, testnet=None, concurrency=16):
+    '''Warms the Fetcher cache with the previous transactions of every
+    input of txs, concurrently. Returns how many were fetched.
+
+    When this thread is already running an event loop (verify() called
+    from a coroutine), the fetches get their own loop on a helper thread
+    and this call blocks until they are done. Coroutines that should not
+    block can await prefetch_async instead'''
+    # with a UTXO set every input is answered locally, misses included
+    if TxIn.utxo_set is not None:
+        return 0
+    tx_ids = [tx_in.prev_tx.hex() for tx in txs for tx_in in tx.tx_ins]
+    tx_ids = [tx_id for tx_id in dict.fromkeys(tx_ids)
+              if not Fetcher.is_cached(tx_id)]
+    if not tx_ids:
+        return 0
+    if testnet is None:
+        testnet = any(tx.testnet for tx in txs)
+    coroutine = prefetch_async(tx_ids, testnet=testnet,
+                               concurrency=concurrency)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+class VerifyTest(TestCase):
+
+    def setUp(self):
+        from secp256k1 import PrivateKey
+        self.key = PrivateKey(0x5eed)
+        script_pubkey = Script([0x76, 0xa9, self.key.point.hash160(), 0x88,
+                                0xac])
+        self.prev = Tx(1, [TxIn(b'\x11' * 32, 0)],
+                       [TxOut(5000, script_pubkey), TxOut(4000, script_pubkey)],
+                       0, testnet=False)
+        Fetcher.cache.put(self.prev.id(), self.prev)
+
+    def tearDown(self):
+        Fetcher.configure()
+
+    def spending_tx(self):
+        tx = Tx(1, [TxIn(self.prev.hash(), i) for i in range(2)],
+                [TxOut(8000, self.prev.tx_outs[0].script_pubkey)], 0,
+                testnet=False)
+        context = tx.sighash_context()
+        for i in range(len(tx.tx_ins)):
+            self.assertTrue(tx.sign_input(i, self.key, context))
+        return tx
+
+    def test_verify_parallel_from_buffer(self):
+        raw = self.spending_tx().serialize()
+        tx, _ = Tx.parse_buffer(memoryview(raw))
+        self.assertIs(type(tx.tx_ins[0].script_sig.cmds[0]), memoryview)
+        self.assertTrue(tx.verify(workers=2))
+        bad = bytearray(raw)
+        bad[-10] ^= 1
+        tx, _ = Tx.parse_buffer(memoryview(bytes(bad)))
+        self.assertFalse(tx.verify(workers=2))
+
+    def test_verify_parallel_fills_sig_cache(self):
+        tx = self.spending_tx()
+        cache = sigcache.SIG_CACHE
+        sigcache.SIG_CACHE = sigcache.SignatureCache()
+        try:
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                self.assertTrue(tx.verify(executor=executor))
+                # what the workers verified is now cached in this process
+                self.assertEqual(len(sigcache.SIG_CACHE), 2)
+                for i, tx_in in enumerate(tx.tx_ins):
+                    sig, sec = tx_in.script_sig.cmds
+                    self.assertTrue(sigcache.SIG_CACHE.contains(
+                        sec, sig[:-1], tx.sig_hash(i)))
+                # and the pool is still usable
+                self.assertTrue(verify_transactions([tx], executor=executor))
+        finally:
+            sigcache.SIG_CACHE = cache
+
+
+class ParseBufferTest(TestCase):
+
+    # a mainnet P2PKH spend
+    RAW_TX = bytes.fromhex(
+        '0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6'
+        'a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e2'
+        '4c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4'
+        'd7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d868'
+        '4c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a9'
+        '14bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976'
+        'a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+
+    def assertSameTx(self, tx, expected):
+        self.assertEqual(tx.serialize(), expected.serialize())
+        self.assertEqual((tx.version, tx.locktime),
+                         (expected.version, expected.locktime))
+        for tx_in, other in zip(tx.tx_ins, expected.tx_ins):
+            self.assertEqual((tx_in.prev_tx, tx_in.prev_index,
+                              tx_in.sequence),
+                             (other.prev_tx, other.prev_index,
+                              other.sequence))
+        for tx_out, other in zip(tx.tx_outs, expected.tx_outs):
+            self.assertEqual(tx_out.amount, other.amount)
+
+    def test_matches_parse(self):
+        from io import BytesIO
+        expected = Tx.parse(BytesIO(self.RAW_TX))
+        self.assertEqual(expected.serialize(), self.RAW_TX)
+        for b in (self.RAW_TX, memoryview(self.RAW_TX)):
+            tx, offset = Tx.parse_buffer(b)
+            self.assertEqual(offset, len(self.RAW_TX))
+            self.assertSameTx(tx, expected)
+        raw_in = expected.tx_ins[0].serialize()
+        tx_in, offset = TxIn.parse_buffer(memoryview(raw_in))
+        self.assertEqual((tx_in.serialize(), offset), (raw_in, len(raw_in)))
+        self.assertEqual(TxIn.parse(BytesIO(raw_in)).serialize(), raw_in)
+        raw_out = expected.tx_outs[1].serialize()
+        tx_out, offset = TxOut.parse_buffer(b'xy' + raw_out, 2)
+        self.assertEqual((tx_out.serialize(), offset),
+                         (raw_out, 2 + len(raw_out)))
+        self.assertEqual(TxOut.parse(BytesIO(raw_out)).amount,
+                         tx_out.amount)
+
+    # 253 inputs need a three byte varint count
+    def test_many_inputs_back_to_back(self):
+        from io import BytesIO
+        tx = Tx(2, [TxIn(bytes([i]) * 32, i, Script([bytes([i]) * 100]))
+                    for i in range(253)],
+                [TxOut(i, Script([0x76, b'\x01' * 20]))
+                 for i in range(3)], 7)
+        raw = tx.serialize()
+        self.assertEqual(raw[4:7], b'\xfd\xfd\x00')
+        expected = Tx.parse(BytesIO(raw))
+        buffer = memoryview(raw + raw)
+        first, offset = Tx.parse_buffer(buffer)
+        second, end = Tx.parse_buffer(buffer, offset)
+        self.assertEqual((offset, end), (len(raw), 2 * len(raw)))
+        self.assertSameTx(first, expected)
+        self.assertSameTx(second, expected)
+
+    def test_segwit_witness_skipped(self):
+        raw = self.RAW_TX
+        witness = b'\x02' + b'\x47' + b'\x30' * 71 + b'\x21' + b'\x02' * 33
+        segwit = raw[:4] + b'\x00\x01' + raw[4:-4] + witness + raw[-4:]
+        tx, offset = Tx.parse_buffer(memoryview(segwit))
+        self.assertEqual(offset, len(segwit))
+        self.assertEqual(tx.serialize(), raw)
+
+    def test_truncated(self):
+        import struct
+        for cut in range(len(self.RAW_TX)):
+            with self.assertRaises((SyntaxError, IndexError, struct.error)):
+                Tx.parse_buffer(memoryview(self.RAW_TX[:cut]))
+
+
+class SigHashTest(TestCase):
+
+    # the textbook way: blank every scriptSig, put the scriptPubKey in
+    # input i, serialize the whole tx and append the hash type
+    def naive_sig_hash(self, tx, input_index, script_pubkey):
+        tx_ins = []
+        for i, tx_in in enumerate(tx.tx_ins):
+            script_sig = script_pubkey if i == input_index else None
+            tx_ins.append(TxIn(tx_in.prev_tx, tx_in.prev_index, script_sig,
+                               tx_in.sequence))
+        copy = Tx(tx.version, tx_ins, tx.tx_outs, tx.locktime)
+        preimage = copy.serialize() + int_to_little_endian(SIGHASH_ALL, 4)
+        return int.from_bytes(hash256(preimage), 'big')
+
+    def test_matches_naive_preimage(self):
+        script_pubkeys = [Script([0x76, 0xa9, bytes([i]) * 20, 0x88, 0xac])
+                          for i in range(5)]
+        tx = Tx(2, [TxIn(bytes([i]) * 32, i, Script([b'\x01' * 71]),
+                         0xfffffffe - i) for i in range(5)],
+                [TxOut(1000 * i, script_pubkeys[i]) for i in range(3)],
+                650000)
+        context = tx.sighash_context()
+        for i, script_pubkey in enumerate(script_pubkeys):
+            self.assertEqual(context.sig_hash(i, script_pubkey),
+                             self.naive_sig_hash(tx, i, script_pubkey))
+
+
+class TxStoreTest(TestCase):
+
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'txs.sqlite')
+            store = TxStore(path, max_entries=2)
+            store.put('aa', b'\x01')
+            store.put('bb', b'\x02')
+            store.put('aa', b'\x01')
+            self.assertEqual(store.get('aa'), b'\x01')
+            store.put('cc', b'\x03')
+            self.assertIsNone(store.get('aa'))
+            self.assertEqual(len(store), 2)
+            store.close()
+            store = TxStore(path, max_entries=2)
+            self.assertTrue(store.contains('cc'))
+            self.assertFalse(store.contains('aa'))
+            self.assertEqual(store.get('cc'), b'\x03')
+            stats = store.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 0))
+            self.assertEqual(stats['size'], 2)
+            store.close()
+
+
+class PrefetchTest(TestCase):
+
+    raw_tx = '0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600'
+
+    def setUp(self):
+        raw_tx = self.raw_tx
+        self.tx_id = tx_id = Tx.parse_buffer(bytes.fromhex(raw_tx))[0].id()
+        self.requested = requested = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requested.append(self.path)
+                body = raw_tx.encode() if self.path == '/tx/{}.hex'.format(
+                    tx_id) else b'not found'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.urls = Fetcher.urls
+        Fetcher.urls = {False: 'http://127.0.0.1:{}'.format(
+            self.server.server_address[1])}
+        Fetcher.configure()
+        self.spending = Tx(1, [TxIn(bytes.fromhex(tx_id), i)
+                               for i in range(3)], [], 0, testnet=False)
+
+    def tearDown(self):
+        Fetcher.urls = self.urls
+        Fetcher.configure()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_prefetch(self):
+        spending, tx_id = self.spending, self.tx_id
+        self.assertEqual(prefetch_transactions([spending, spending]), 1)
+        self.assertEqual(self.requested, ['/tx/{}.hex'.format(tx_id)])
+        self.assertEqual(prefetch_transactions([spending]), 0)
+        self.assertEqual(Fetcher.fetch(tx_id).id(), tx_id)
+        self.assertEqual(len(self.requested), 1)
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            Fetcher.configure(store_path=os.path.join(directory, 'txs.sqlite'))
+            self.assertEqual(prefetch_transactions([self.spending]), 1)
+            Fetcher.fetch(self.tx_id)
+            Fetcher.cache.clear()
+            self.assertEqual(prefetch_transactions([self.spending]), 0)
+            Fetcher.fetch(self.tx_id)
+            stats = Fetcher.stats()
+            self.assertEqual((stats['lookups'], stats['memory_hits'],
+                              stats['store_hits'], stats['network_fetches']),
+                             (2, 1, 1, 1))
+            self.assertEqual(stats['hit_rate'], 1.0)
+            # is_cached during the second prefetch did not count as a read
+            self.assertEqual(stats['store']['hits'], 1)
+            Fetcher.configure()
+
+    def test_prefetch_in_running_loop(self):
+        async def prefetch():
+            return prefetch_transactions([self.spending])
+
+        self.assertEqual(asyncio.run(prefetch()), 1)
+        self.assertEqual(asyncio.run(prefetch()), 0)
+        self.assertEqual(len(self.requested), 1)
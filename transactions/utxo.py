@@ -0,0 +1,279 @@
+from helper import (
+    encode_varint,
+    int_to_little_endian,
+    parse_varint_buffer,
+    )
+from script import Script
+from transactions import (
+    Fetcher,
+    Tx,
+    TxIn,
+    TxOut,
+    verify_transactions,
+    )
+from unittest import TestCase
+
+import os
+import sqlite3
+import tempfile
+import threading
+
+COINBASE_PREV_TX = b'\x00' * 32
+COINBASE_PREV_INDEX = 0xffffffff
+
+
+def outpoint_key(txid, index):
+    return txid + int_to_little_endian(index, 4)
+
+
+# varint amount followed by the serialized scriptPubKey
+def encode_coin(tx_out):
+    return encode_varint(tx_out.amount) + tx_out.script_pubkey.serialize()
+
+
+def decode_coin(value):
+    amount, offset = parse_varint_buffer(value, 0)
+    script_pubkey, _ = Script.parse_buffer(value, offset)
+    return TxOut(amount, script_pubkey)
+
+
+def is_coinbase(tx):
+    return len(tx.tx_ins) == 1 \
+        and tx.tx_ins[0].prev_tx == COINBASE_PREV_TX \
+        and tx.tx_ins[0].prev_index == COINBASE_PREV_INDEX
+
+
+def is_unspendable(tx_out):
+    cmds = tx_out.script_pubkey.cmds
+    return len(cmds) > 0 and cmds[0] == 0x6a
+
+
+class UtxoSet:
+    '''Unspent outputs keyed by (txid, index), amount and scriptPubKey only.
+
+    Rows live in sqlite with a 36 byte outpoint key (txid + LE index) and
+    a varint amount + script value. Changes go to an in-memory write-back
+    cache and reach the database in one transaction when more than
+    cache_size outpoints are held or on flush(). Blocks are applied with
+    connect_block(), which returns the undo data disconnect_block() needs
+    to roll them back on a reorg.
+    '''
+
+    def __init__(self, path, cache_size=100000):
+        self.path = path
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS utxos '
+                        '(outpoint BLOB PRIMARY KEY, coin BLOB NOT NULL) '
+                        'WITHOUT ROWID')
+        self.db.commit()
+        # outpoint -> TxOut, or None once spent
+        self.cache = {}
+        self.dirty = set()
+
+    def get(self, txid, index):
+        key = outpoint_key(txid, index)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            row = self.db.execute('SELECT coin FROM utxos WHERE outpoint = ?',
+                                  (key,)).fetchone()
+            tx_out = decode_coin(row[0]) if row is not None else None
+            self.cache[key] = tx_out
+            self.trim()
+            return tx_out
+
+    def add(self, txid, index, tx_out):
+        key = outpoint_key(txid, index)
+        with self.lock:
+            self.cache[key] = tx_out
+            self.dirty.add(key)
+            self.trim()
+
+    def spend(self, txid, index):
+        '''Removes the outpoint and returns its TxOut for undo data'''
+        with self.lock:
+            tx_out = self.get(txid, index)
+            if tx_out is None:
+                raise KeyError('missing or spent output {}:{}'.format(
+                    txid.hex(), index))
+            key = outpoint_key(txid, index)
+            self.cache[key] = None
+            self.dirty.add(key)
+            return tx_out
+
+    def connect_block(self, txs):
+        '''Spends the inputs and adds the outputs of a block's transactions,
+        in order. Returns undo data for disconnect_block. Changes are
+        staged and applied together once every input has been found, so a
+        block with a missing or spent input raises KeyError and leaves the
+        set as it was'''
+        undo = []
+        with self.lock:
+            # outpoint -> TxOut, or None once spent within this block
+            changes = {}
+            for tx in txs:
+                if not is_coinbase(tx):
+                    for tx_in in tx.tx_ins:
+                        key = outpoint_key(tx_in.prev_tx, tx_in.prev_index)
+                        if key in changes:
+                            tx_out = changes[key]
+                        else:
+                            tx_out = self.get(tx_in.prev_tx, tx_in.prev_index)
+                        if tx_out is None:
+                            raise KeyError('missing or spent output {}:{}'.
+                                           format(tx_in.prev_tx.hex(),
+                                                  tx_in.prev_index))
+                        changes[key] = None
+                        undo.append((tx_in.prev_tx, tx_in.prev_index, tx_out))
+                txid = tx.hash()
+                for index, tx_out in enumerate(tx.tx_outs):
+                    if not is_unspendable(tx_out):
+                        changes[outpoint_key(txid, index)] = tx_out
+            self.apply(changes)
+        return undo
+
+    def disconnect_block(self, txs, undo):
+        '''Rolls back connect_block(txs), undo being what it returned.
+        Transactions are undone last to first: their outputs removed, then
+        the outputs their inputs spent put back, except those created by
+        the block itself, which no longer exist once it is gone'''
+        txids = {tx.hash() for tx in txs}
+        with self.lock:
+            changes = {}
+            position = len(undo)
+            for tx in reversed(txs):
+                txid = tx.hash()
+                for index in range(len(tx.tx_outs)):
+                    changes[outpoint_key(txid, index)] = None
+                if is_coinbase(tx):
+                    continue
+                position -= len(tx.tx_ins)
+                if position < 0:
+                    raise ValueError('undo data does not match the block')
+                for prev_tx, prev_index, tx_out in \
+                        undo[position:position + len(tx.tx_ins)]:
+                    if prev_tx not in txids:
+                        changes[outpoint_key(prev_tx, prev_index)] = tx_out
+            if position != 0:
+                raise ValueError('undo data does not match the block')
+            self.apply(changes)
+
+    # Writes a whole block's changes to the cache, trimming only after
+    def apply(self, changes):
+        self.cache.update(changes)
+        self.dirty.update(changes)
+        self.trim()
+
+    def trim(self):
+        if len(self.cache) > self.cache_size:
+            self.flush()
+            self.cache.clear()
+
+    def flush(self):
+        with self.lock:
+            upserts = []
+            deletes = []
+            for key in self.dirty:
+                tx_out = self.cache[key]
+                if tx_out is None:
+                    deletes.append((key,))
+                else:
+                    upserts.append((key, encode_coin(tx_out)))
+            with self.db:
+                self.db.executemany('DELETE FROM utxos WHERE outpoint = ?',
+                                    deletes)
+                self.db.executemany('INSERT OR REPLACE INTO utxos '
+                                    '(outpoint, coin) VALUES (?, ?)', upserts)
+            self.dirty.clear()
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute('SELECT COUNT(*) FROM utxos').fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class UtxoSetTest(TestCase):
+
+    def test_connect_disconnect(self):
+        p2pkh = Script([0x76, 0xa9, b'\x11' * 20, 0x88, 0xac])
+        coinbase = Tx(1, [TxIn(COINBASE_PREV_TX, COINBASE_PREV_INDEX)],
+                      [TxOut(5000, p2pkh), TxOut(0, Script([0x6a]))], 0)
+        spend = Tx(1, [TxIn(coinbase.hash(), 0)],
+                   [TxOut(3000, p2pkh), TxOut(1500, p2pkh)], 0)
+        with tempfile.TemporaryDirectory() as directory:
+            utxos = UtxoSet(os.path.join(directory, 'utxo.sqlite'),
+                            cache_size=2)
+            utxos.connect_block([coinbase])
+            self.assertEqual(utxos.get(coinbase.hash(), 0).amount, 5000)
+            self.assertIsNone(utxos.get(coinbase.hash(), 1))
+            TxIn.utxo_set = utxos
+            try:
+                self.assertEqual(spend.fee(), 500)
+            finally:
+                TxIn.utxo_set = None
+            undo = utxos.connect_block([spend])
+            self.assertIsNone(utxos.get(coinbase.hash(), 0))
+            self.assertEqual(len(utxos), 2)
+            with self.assertRaises(KeyError):
+                utxos.connect_block([spend])
+            # a second spend of the coinbase output is missing from the
+            # set, and must not fall back to fetching the coinbase tx
+            double = Tx(1, [TxIn(coinbase.hash(), 0)], [TxOut(3000, p2pkh)],
+                        0)
+            network_fetches = Fetcher.network_fetches
+            TxIn.utxo_set = utxos
+            try:
+                with self.assertRaises(KeyError):
+                    double.fee()
+                self.assertFalse(double.verify())
+                self.assertFalse(verify_transactions([double]))
+            finally:
+                TxIn.utxo_set = None
+            self.assertEqual(Fetcher.network_fetches, network_fetches)
+            utxos.disconnect_block([spend], undo)
+            utxos.close()
+            utxos = UtxoSet(os.path.join(directory, 'utxo.sqlite'))
+            tx_out = utxos.get(coinbase.hash(), 0)
+            self.assertEqual(tx_out.amount, 5000)
+            self.assertEqual(tx_out.script_pubkey.serialize(),
+                             p2pkh.serialize())
+            self.assertIsNone(utxos.get(spend.hash(), 0))
+            self.assertEqual(len(utxos), 1)
+            utxos.close()
+
+    def test_block_spending_its_own_outputs(self):
+        p2pkh = Script([0x76, 0xa9, b'\x22' * 20, 0x88, 0xac])
+        coinbase = Tx(1, [TxIn(COINBASE_PREV_TX, COINBASE_PREV_INDEX)],
+                      [TxOut(5000, p2pkh)], 0)
+        first = Tx(1, [TxIn(coinbase.hash(), 0)], [TxOut(4000, p2pkh)], 0)
+        second = Tx(1, [TxIn(first.hash(), 0)], [TxOut(3000, p2pkh)], 0)
+        missing = Tx(1, [TxIn(b'\x33' * 32, 0)], [TxOut(1, p2pkh)], 0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'utxo.sqlite')
+            utxos = UtxoSet(path, cache_size=1)
+            utxos.connect_block([coinbase])
+            # the missing input comes after spends that must not stick,
+            # even though the tiny cache flushes on every lookup
+            with self.assertRaises(KeyError):
+                utxos.connect_block([first, second, missing])
+            utxos.close()
+            utxos = UtxoSet(path, cache_size=1)
+            self.assertEqual(utxos.get(coinbase.hash(), 0).amount, 5000)
+            self.assertIsNone(utxos.get(first.hash(), 0))
+            undo = utxos.connect_block([first, second])
+            self.assertIsNone(utxos.get(first.hash(), 0))
+            self.assertEqual(utxos.get(second.hash(), 0).amount, 3000)
+            utxos.disconnect_block([first, second], undo)
+            self.assertIsNone(utxos.get(first.hash(), 0))
+            self.assertIsNone(utxos.get(second.hash(), 0))
+            self.assertEqual(utxos.get(coinbase.hash(), 0).amount, 5000)
+            self.assertEqual(len(utxos), 1)
+            with self.assertRaises(ValueError):
+                utxos.disconnect_block([first, second], undo[:1])
+            utxos.close()